@@ -0,0 +1,97 @@
+# Copyright (c) 2016-2017, Matteo Cafasso
+# All rights reserved.
+
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+
+# 3. Neither the name of the copyright holder nor the names of its contributors
+# may be used to endorse or promote products derived from this software without
+# specific prior written permission.
+
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+# THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS
+# BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY,
+# OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT
+# OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE
+# OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE,
+# EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+"""Benchmark of FileSystem.nodes('/') path translation.
+
+The nodes of the disk are listed translating their paths through
+the Inspection record resolved at mount time and then querying
+the appliance for the Operating System type and drive mappings
+of each path, as FileSystem did before the record was introduced.
+
+    python benchmarks/inspection_paths.py windows.qcow2
+
+"""
+
+
+import os
+import time
+import argparse
+
+from vminspect.filesystem import FileSystem, posix_path
+
+
+def main():
+    arguments = parse_arguments()
+
+    with FileSystem(arguments.disk) as filesystem:
+        print("Disk: %s, %s" % (arguments.disk, filesystem.osname))
+
+        translations = (('inspection', filesystem.path),
+                        ('per path queries', QueryingPath(filesystem)))
+
+        for _ in range(arguments.repeat):
+            for name, translation in translations:
+                filesystem.path = translation
+
+                start = time.perf_counter()
+                nodes = sum(1 for _ in filesystem.nodes('/'))
+                elapsed = time.perf_counter() - start
+
+                print("%s: %d nodes in %.2fs, %d nodes/s" %
+                      (name, nodes, elapsed, nodes / elapsed))
+
+
+class QueryingPath:
+    """Path translation querying the appliance for each path."""
+    def __init__(self, filesystem):
+        self.handler = filesystem._handler
+        self.root = filesystem.inspection.root
+
+    def __call__(self, *segments):
+        if self.handler.inspect_get_type(self.root) == 'windows':
+            drive = self.handler.inspect_get_drive_mappings(self.root)[0][0]
+
+            return "%s:%s" % (drive,
+                              os.path.join(*segments).replace('/', '\\'))
+        else:
+            return posix_path(*segments)
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('disk', type=str, help='path to disk image')
+    parser.add_argument('-n', '--repeat', type=int, default=1,
+                        help='amount of runs of both translations')
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,162 @@
+# Copyright (c) 2016-2017, Matteo Cafasso
+# All rights reserved.
+
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+
+# 3. Neither the name of the copyright holder nor the names of its contributors
+# may be used to endorse or promote products derived from this software without
+# specific prior written permission.
+
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+# THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS
+# BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY,
+# OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT
+# OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE
+# OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE,
+# EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+"""Benchmark of the disk comparison within one shared appliance
+against one appliance per disk.
+
+The two disks are compared with DiskComparator in both layouts
+reporting the mount and the total wall-clock time as well as the peak
+resident memory of the appliances processes, sampled from /proc.
+
+The appliances must be children of this process to be sampled,
+as with the direct libguestfs backend (LIBGUESTFS_BACKEND=direct).
+
+    python benchmarks/shared_appliance.py disk0.qcow2 disk1.qcow2
+
+"""
+
+
+import os
+import time
+import argparse
+import threading
+
+from vminspect.comparator import DiskComparator
+
+
+def main():
+    arguments = parse_arguments()
+    flags = {'concurrent': arguments.concurrent,
+             'identify': arguments.identify,
+             'size': arguments.size}
+
+    for _ in range(arguments.repeat):
+        for shared in (False, True):
+            mounted, elapsed, memory = benchmark(
+                arguments.disk0, arguments.disk1, shared, flags)
+
+            print("%s: mounted in %.2fs, compared in %.2fs, %d MiB peak RSS" %
+                  ('shared' if shared else 'separate',
+                   mounted, elapsed, memory // 2**20))
+
+
+def benchmark(disk0, disk1, shared, flags):
+    """Compares the disks returning the mount time,
+    the total time and the peak memory of the appliances.
+
+    """
+    with MemorySampler() as sampler:
+        start = time.perf_counter()
+
+        with DiskComparator(disk0, disk1, shared=shared) as comparator:
+            mounted = time.perf_counter() - start
+            comparator.compare(**flags)
+
+        elapsed = time.perf_counter() - start
+
+    return mounted, elapsed, sampler.peak
+
+
+class MemorySampler:
+    """Samples the resident memory of the processes descending
+    from the current one keeping its peak.
+
+    """
+    def __init__(self, interval=0.2):
+        self.peak = 0
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+
+        return self
+
+    def __exit__(self, *_):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, descendants_memory(os.getpid()))
+
+
+def descendants_memory(pid):
+    """Returns the resident memory in bytes of the descendants of pid."""
+    parents = {}
+
+    for entry in os.listdir('/proc'):
+        if entry.isdigit():
+            try:
+                with open('/proc/%s/stat' % entry) as stat:
+                    # the command name might contain spaces
+                    fields = stat.read().rsplit(')', 1)[1].split()
+            except OSError:
+                continue  # process exited meanwhile
+
+            parents[int(entry)] = (int(fields[1]), int(fields[21]))
+
+    descendants = {pid}
+    memory = 0
+
+    for _ in range(MAX_DEPTH):
+        children = {p for p, (ppid, _) in parents.items()
+                    if ppid in descendants and p not in descendants}
+        if not children:
+            break
+
+        descendants |= children
+        memory += sum(parents[p][1] for p in children)
+
+    return memory * os.sysconf('SC_PAGE_SIZE')
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('disk0', type=str, help='first disk image')
+    parser.add_argument('disk1', type=str, help='second disk image')
+    parser.add_argument('-c', '--concurrent', action='store_true',
+                        default=False, help='hash the disks concurrently')
+    parser.add_argument('-i', '--identify', action='store_true',
+                        default=False, help='report file types')
+    parser.add_argument('-s', '--size', action='store_true', default=False,
+                        help='report file sizes')
+    parser.add_argument('-n', '--repeat', type=int, default=1,
+                        help='amount of runs of both layouts')
+
+    return parser.parse_args()
+
+
+MAX_DEPTH = 8
+
+
+if __name__ == '__main__':
+    main()
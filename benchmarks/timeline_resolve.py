@@ -0,0 +1,148 @@
+# Copyright (c) 2016-2017, Matteo Cafasso
+# All rights reserved.
+
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+
+# 3. Neither the name of the copyright holder nor the names of its contributors
+# may be used to endorse or promote products derived from this software without
+# specific prior written permission.
+
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+# THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS
+# BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY,
+# OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT
+# OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE
+# OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE,
+# EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+"""Benchmark of the USN journal events resolution into timeline entries.
+
+A synthetic NTFS tree and USN journal are generated in memory:
+most events refer to files still present on the disk, the others
+to files created and deleted within folders which might be deleted too,
+their paths are then rebuilt from the journal folder events.
+
+No disk image nor appliance is needed.
+
+    python benchmarks/timeline_resolve.py --records 1000000
+
+"""
+
+
+import time
+import random
+import argparse
+from collections import defaultdict
+
+from vminspect.timeline import Dirent, JrnlEvent, generate_timeline
+
+
+def main():
+    arguments = parse_arguments()
+
+    start = time.perf_counter()
+    content, journal = generate_fixture(arguments.files or
+                                        arguments.records // 2,
+                                        arguments.records, arguments.seed)
+    print("Fixture: %d inodes, %d events generated in %.2fs" %
+          (len(content), len(journal), time.perf_counter() - start))
+
+    for _ in range(arguments.repeat):
+        start = time.perf_counter()
+        events = sum(1 for _ in generate_timeline(journal, content))
+        elapsed = time.perf_counter() - start
+
+        print("Resolved %d events in %.2fs, %d events/s" %
+              (events, elapsed, events / elapsed))
+
+
+def generate_fixture(files, records, seed=0):
+    """Generates the file system content and the USN journal events
+    as expected by generate_timeline.
+
+    Returns the {inode: [Dirent]} dictionary and the list of JrnlEvent.
+
+    """
+    rand = random.Random(seed)
+    content = defaultdict(list)
+    content[ROOT].append(Dirent(ROOT, 'C:\\', 0, 'd', True, 0, 0, 0, 0))
+    folders = [ROOT]
+
+    for inode in range(ROOT + 1, ROOT + 1 + files):
+        parent = content[rand.choice(folders)][0]
+        folder = rand.random() < FOLDERS_RATIO
+        path = '%s\\n%d' % (parent.path.rstrip('\\'), inode)
+
+        content[inode].append(Dirent(inode, path, 4096, 'd' if folder else 'r',
+                                     rand.random() < ALLOCATED_RATIO,
+                                     0, 0, 0, 0))
+
+        if folder:
+            folders.append(inode)
+
+    journal = []
+    deleted = ROOT + 1 + files  # first inode not on disk
+    deleted_folders = [ROOT]
+
+    for index in range(records):
+        timestamp = '2017-01-01 00:00:%09d' % index
+
+        if rand.random() < EXISTING_RATIO:
+            inode = rand.randrange(ROOT + 1, deleted)
+            name = content[inode][0].path.rsplit('\\', 1)[1]
+
+            journal.append(JrnlEvent(inode, rand.choice(folders), name,
+                                     timestamp, ['DATA_EXTEND'], ['ARCHIVE']))
+        else:
+            inode = deleted + index
+            parent = (rand.choice(deleted_folders) if rand.random() < 0.5
+                      else rand.choice(folders))
+
+            if rand.random() < FOLDERS_RATIO * 3:
+                deleted_folders.append(inode)
+                changes, attributes = ['FILE_DELETE'], ['DIRECTORY']
+            else:
+                changes, attributes = ['FILE_CREATE'], ['ARCHIVE']
+
+            journal.append(JrnlEvent(inode, parent, 'x%d' % inode,
+                                     timestamp, changes, attributes))
+
+    return content, journal
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('-r', '--records', type=int, default=1000000,
+                        help='amount of USN journal events')
+    parser.add_argument('-f', '--files', type=int, default=None,
+                        help='amount of disk inodes, half the records '
+                        'by default')
+    parser.add_argument('-n', '--repeat', type=int, default=3,
+                        help='amount of timed runs')
+    parser.add_argument('-s', '--seed', type=int, default=0,
+                        help='random seed of the fixture')
+
+    return parser.parse_args()
+
+
+ROOT = 5  # NTFS root folder MFT record
+FOLDERS_RATIO = 0.1
+ALLOCATED_RATIO = 0.9
+EXISTING_RATIO = 0.7
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,190 @@
+# Copyright (c) 2016-2017, Matteo Cafasso
+# All rights reserved.
+
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+
+# 3. Neither the name of the copyright holder nor the names of its contributors
+# may be used to endorse or promote products derived from this software without
+# specific prior written permission.
+
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+# THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS
+# BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY,
+# OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT
+# OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE
+# OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE,
+# EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+"""Benchmark of the USN journal parser throughput in records per second.
+
+A synthetic $UsnJrnl:$J stream is written into a file: a sparse head
+followed by pages of version 2 and 3 records padded with zeros
+as NTFS does. usn_journal, which maps the file and skips its holes,
+is timed against parse_journal_file which reads it whole.
+
+No disk image nor appliance is needed, an extracted journal
+can be given in place of the synthetic one.
+
+    python benchmarks/usnjrnl_parse.py --records 1000000
+
+"""
+
+
+import os
+import time
+import random
+import argparse
+from tempfile import NamedTemporaryFile
+
+from vminspect.usnjrnl import usn_journal, parse_journal_file
+from vminspect.usnjrnl import RECORD_HEADER, V2_RECORD, V3_RECORD
+
+
+def main():
+    arguments = parse_arguments()
+
+    if arguments.journal is not None:
+        benchmark(arguments.journal, arguments.repeat)
+    elif arguments.output is not None:
+        generate_fixture(arguments.output, arguments.records,
+                         arguments.hole * 2**20, arguments.seed)
+        benchmark(arguments.output, arguments.repeat)
+    else:
+        with NamedTemporaryFile() as journal:
+            generate_fixture(journal.name, arguments.records,
+                             arguments.hole * 2**20, arguments.seed)
+            benchmark(journal.name, arguments.repeat)
+
+
+def benchmark(path, repeat):
+    print("Journal: %d bytes" % os.path.getsize(path))
+
+    for name, parser in (('usn_journal', usn_journal),
+                         ('parse_journal_file', parse_file)):
+        best = 0
+
+        for _ in range(repeat):
+            start = time.perf_counter()
+            records = sum(1 for _ in parser(path))
+            best = max(best, records / (time.perf_counter() - start))
+
+        print("%s: %d records, %d records/s" % (name, records, best))
+
+
+def parse_file(path):
+    with open(path, 'rb') as journal_file:
+        yield from parse_journal_file(journal_file)
+
+
+def generate_fixture(path, records, hole=0, seed=0):
+    """Writes a synthetic USN journal with the given amount of records
+    after a sparse head of hole bytes.
+
+    Records do not cross the PAGE_SIZE boundaries,
+    the page remainders and some of the records gaps are zeros.
+
+    """
+    rand = random.Random(seed)
+    page = bytearray()
+
+    with open(path, 'wb') as journal:
+        journal.truncate(hole)
+        journal.seek(hole)
+
+        for index in range(records):
+            name = 'file%d.%s' % (index, rand.choice(EXTENSIONS))
+
+            if rand.random() < V3_RATIO:
+                record = v3_record(rand, name)
+            else:
+                record = v2_record(rand, name)
+
+            if len(page) + len(record) > PAGE_SIZE:
+                journal.write(page.ljust(PAGE_SIZE, b'\0'))
+                page = bytearray()
+
+            page += record
+
+            if rand.random() < GAPS_RATIO:
+                page += bytes(8 * rand.randrange(1, 4))
+
+        journal.write(page.ljust(PAGE_SIZE, b'\0'))
+
+
+def v2_record(rand, name):
+    name = name.encode('utf-16-le')
+    offset = RECORD_HEADER.size + V2_RECORD.size
+    body = V2_RECORD.pack(
+        rand.randrange(1 << 32), rand.randrange(1 << 16), 0,
+        rand.randrange(1 << 32), rand.randrange(1 << 16), 0,
+        rand.randrange(1 << 40), FILETIME + rand.randrange(10**15),
+        rand.choice(REASONS), 0, 0, rand.choice(ATTRIBUTES),
+        len(name), offset)
+
+    return record(2, body, name)
+
+
+def v3_record(rand, name):
+    name = name.encode('utf-16-le')
+    offset = RECORD_HEADER.size + V3_RECORD.size
+    body = V3_RECORD.pack(
+        rand.randrange(1 << 64), rand.randrange(1 << 64),
+        rand.randrange(1 << 64), rand.randrange(1 << 64),
+        rand.randrange(1 << 40), FILETIME + rand.randrange(10**15),
+        rand.choice(REASONS), 0, 0, rand.choice(ATTRIBUTES),
+        len(name), offset)
+
+    return record(3, body, name)
+
+
+def record(version, body, name):
+    length = RECORD_HEADER.size + len(body) + len(name)
+    length += -length % 8
+
+    data = RECORD_HEADER.pack(length, version, 0) + body + name
+
+    return data.ljust(length, b'\0')
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('-r', '--records', type=int, default=1000000,
+                        help='amount of synthetic records')
+    parser.add_argument('--hole', type=int, default=256,
+                        help='size in MiB of the sparse journal head')
+    parser.add_argument('-n', '--repeat', type=int, default=3,
+                        help='amount of timed runs, the best is reported')
+    parser.add_argument('-s', '--seed', type=int, default=0,
+                        help='random seed of the fixture')
+    parser.add_argument('-o', '--output', type=str, default=None,
+                        help='keep the synthetic journal at the given path')
+    parser.add_argument('-j', '--journal', type=str, default=None,
+                        help='benchmark an existing journal file instead')
+
+    return parser.parse_args()
+
+
+PAGE_SIZE = 4096
+V3_RATIO = 0.2
+GAPS_RATIO = 0.05
+FILETIME = 131000000000000000  # 2016 in 100ns intervals since 1601
+REASONS = (0x01, 0x02, 0x100, 0x200, 0x80000000 | 0x100)
+ATTRIBUTES = (0x10, 0x20, 0x80)
+EXTENSIONS = ('txt', 'dll', 'exe', 'log', 'tmp')
+
+
+if __name__ == '__main__':
+    main()
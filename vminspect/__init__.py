@@ -31,20 +31,32 @@
 from vminspect.vtscan import VTScanner
 from vminspect.usnjrnl import usn_journal
 from vminspect.winevtx import WinEventLog
+from vminspect.hashcache import HashCache
+from vminspect.manifest import Manifest
+from vminspect.fsindex import FileSystemIndex
 from vminspect.vulnscan import VulnScanner
-from vminspect.filesystem import FileSystem
-from vminspect.comparator import DiskComparator
+from vminspect.filesystem import FileSystem, FileSystemPool, HashPolicy
+from vminspect.filesystem import LocalFileSystem, ApplianceProfile
+from vminspect.comparator import DiskComparator, MultiDiskComparator
 from vminspect.timeline import FSTimeline, NTFSTimeline
 from vminspect.winreg import RegistryHive, registry_root
 from vminspect.winreg import registries_path, user_registries_path
 
-__all__ = ['FileSystem',
+__all__ = ['ApplianceProfile',
+           'FileSystem',
+           'FileSystemPool',
+           'FileSystemIndex',
+           'LocalFileSystem',
+           'Manifest',
+           'HashCache',
+           'HashPolicy',
            'RegistryHive',
            'registry_root',
            'registries_path',
            'user_registries_path',
            'usn_journal',
            'DiskComparator',
+           'MultiDiskComparator',
            'FSTimeline',
            'NTFSTimeline',
            'VulnScanner',
@@ -31,40 +31,122 @@
 """Module for comparing Virtual Machine Disk Images."""
 
 
+import os
+import stat
 import logging
-from itertools import chain
+import threading
+from itertools import chain, islice
 from pebble import concurrent
 from pathlib import Path, PurePath
 from tempfile import NamedTemporaryFile
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 from vminspect.winreg import RegistryHive, registry_root
-from vminspect.filesystem import FileSystem, hash_filesystem
+from vminspect.extraction import ExtractionRequest, extract
+from vminspect.imagediff import changed_ranges, overlapping
+from vminspect.filesystem import open_filesystem, hash_files
+from vminspect.filesystem import default_policy
+from vminspect.filesystem import shared_filesystems, sorted_checksums
+from vminspect.filesystem import disk_partitions, map_partitions
+from vminspect.manifest import Manifest, create_manifest, is_manifest
 from vminspect.winreg import user_registries_path, registries_path
 
 
 class DiskComparator:
-    """Performs an in depth comparison of two given disk images."""
-    def __init__(self, disk0, disk1):
+    """Performs an in depth comparison of two given disk images.
+
+    pool is an optional FileSystemPool used for mounting the disks,
+    both appliances are acquired from it at once.
+
+    If shared is True, both disks are mounted within a single appliance
+    halving memory usage and boot time. Calls to the shared appliance
+    are serialized, concurrent hashing gains little in this mode.
+
+    hashcache is an optional HashCache consulted before hashing files.
+
+    Either disk can be a directory of the host holding a mounted
+    or extracted tree, it is served by a LocalFileSystem.
+
+    profile sets the resources of the appliances, see appliance_profile.
+
+    partition selects the Operating System root or data file system
+    to compare on both disks, see compare_partitions to compare them all.
+
+    Either disk can be a manifest created by create_manifest,
+    files are then compared against it without mounting the disk.
+
+    """
+    def __init__(self, disk0, disk1, pool=None, shared=False, hashcache=None,
+                 profile=None, partition=None):
         self.disks = (disk0, disk1)
+        self.pool = pool
+        self.shared = shared
+        self.profile = profile
+        self.partition = partition
+        self.hashcache = hashcache
         self.filesystems = ()
         self._comparison = {}
         self.logger = logging.getLogger(
             "%s.%s" % (self.__module__, self.__class__.__name__))
 
     def __enter__(self):
-        self.filesystems = (FileSystem(self.disks[0]),
-                            FileSystem(self.disks[1]))
+        manifests = [is_manifest(d) for d in self.disks]
+
+        if self.shared and not any(manifests) and \
+           not any(os.path.isdir(d) for d in self.disks):
+            self.filesystems = shared_filesystems(*self.disks,
+                                                  hashcache=self.hashcache,
+                                                  profile=self.profile,
+                                                  partition=self.partition)
+        else:
+            self.filesystems = tuple(
+                Manifest(d) if manifest else
+                open_filesystem(d, pool=self.pool, hashcache=self.hashcache,
+                                profile=self.profile, partition=self.partition)
+                for d, manifest in zip(self.disks, manifests))
 
-        for filesystem in self.filesystems:
-            filesystem.mount()
+            self._mount_filesystems(manifests)
 
         return self
 
+    def _mount_filesystems(self, manifests):
+        """Mounts the file systems, the pool appliances are acquired at once
+        as holding one while waiting for the other could deadlock the pool.
+
+        """
+        images = [not manifest and not os.path.isdir(d)
+                  for d, manifest in zip(self.disks, manifests)]
+        appliances = []
+
+        if self.pool is not None and any(images):
+            appliances = self.pool.acquire_many(images.count(True))
+
+        try:
+            for filesystem, image in zip(self.filesystems, images):
+                if isinstance(filesystem, Manifest):
+                    continue
+                elif image and appliances:
+                    filesystem.mount(appliance=appliances.pop())
+                else:
+                    filesystem.mount()
+        except BaseException:
+            for appliance in appliances:
+                self.pool.release(appliance, None)
+
+            self.__exit__()
+
+            raise
+
     def __exit__(self, *_):
         for filesystem in self.filesystems:
-            filesystem.umount()
-
-    def compare(self, concurrent=False, identify=False, size=False):
+            if isinstance(filesystem, Manifest):
+                filesystem.close()
+            else:
+                filesystem.umount()
+
+    def compare(self, concurrent=False, identify=False, size=False,
+                metadata=False, trust_metadata=False, blocks=False,
+                engine='appliance', dedupe=False, policy=None):
         """Compares the two disks according to flags.
 
         Generates the following report:
@@ -85,22 +167,50 @@ class DiskComparator:
         The identify and size keywords will add respectively the type
         and the size of the files to the results.
 
+        If metadata is True, only the files which metadata differ are hashed.
+        See compare_filesystems for the trust_metadata and blocks keywords
+        and FileSystem.checksums for the engine, dedupe and policy ones.
+
         """
-        self.logger.debug("Comparing FS contents.")
-        results = compare_filesystems(self.filesystems[0], self.filesystems[1],
-                                      concurrent=concurrent)
+        return collect_comparison(self.compare_iter(
+            concurrent=concurrent, identify=identify, size=size,
+            metadata=metadata, trust_metadata=trust_metadata, blocks=blocks,
+            engine=engine, dedupe=dedupe, policy=policy))
 
-        if identify:
-            self.logger.debug("Gatering file types.")
-            results = files_type(self.filesystems[0], self.filesystems[1],
-                                 results)
+    def compare_iter(self, concurrent=False, identify=False, size=False,
+                     metadata=False, trust_metadata=False, blocks=False,
+                     engine='appliance', dedupe=False, policy=None):
+        """Compares the two disks yielding the differences
+        as the merge-join of the two file lists finds them.
 
-        if size:
-            self.logger.debug("Gatering file sizes.")
-            results = files_size(self.filesystems[0], self.filesystems[1],
-                                 results)
+        Each difference is yielded as the report key and the file.
 
-        return results
+            'created_files', {'path': '/file/in/disk1/not/in/disk0',
+                              'sha1': 'sha1_of_the_file'}
+
+        Only the join is streamed: both disks are hashed and externally
+        sorted before the first difference is yielded, in metadata mode
+        both file lists are gathered in memory first.
+
+        Types and sizes are gathered for a batch of differences
+        while the following one is being compared.
+
+        See compare for the keywords.
+
+        """
+        self.logger.debug("Comparing FS contents.")
+        differences = filesystem_differences(
+            self.filesystems[0], self.filesystems[1], concurrent=concurrent,
+            metadata=metadata, trust_metadata=trust_metadata, blocks=blocks,
+            engine=engine, dedupe=dedupe, policy=policy)
+
+        if identify or size:
+            self.logger.debug("Gatering file types and sizes.")
+            differences = enrich_differences(
+                self.filesystems[0], self.filesystems[1], differences,
+                identify=identify, size=size)
+
+        yield from differences
 
     def extract(self, disk, files, path='.'):
         """Extracts the given files from the given disk.
@@ -120,6 +230,8 @@ class DiskComparator:
 
         """
         self.logger.debug("Extracting files.")
+        self._assert_mounted()
+
         extracted_files, failed = self._extract_files(disk, files, path)
 
         return {'extracted_files': [f for f in extracted_files.keys()],
@@ -147,6 +259,7 @@ class DiskComparator:
         """
         self.logger.debug("Comparing Windows registries.")
 
+        self._assert_mounted()
         self._assert_windows()
 
         return compare_registries(self.filesystems[0], self.filesystems[1],
@@ -167,12 +280,226 @@ class DiskComparator:
 
         return extracted, failed
 
+    def _assert_mounted(self):
+        if any(isinstance(fs, Manifest) for fs in self.filesystems):
+            raise RuntimeError("Manifests do not contain the files content")
+
     def _assert_windows(self):
         if not all((fs.osname == 'windows' for fs in self.filesystems)):
             raise RuntimeError("Both disks must contain a Windows File System")
 
 
-def compare_filesystems(fs0, fs1, concurrent=False):
+class MultiDiskComparator:
+    """Compares a baseline disk image against many target disk images.
+
+    The baseline is mounted and hashed once into a Manifest,
+    the targets are then mounted and compared against it concurrently
+    by up to workers threads, each target within its own appliance
+    (or the pool ones if a FileSystemPool is given, it must hold
+    at least two appliances as the baseline keeps one).
+
+    The baseline registry hives are parsed once as well
+    and reused for all the targets.
+
+    The baseline can be a manifest created by create_manifest,
+    it is then used as it is and registries cannot be compared.
+
+    """
+    def __init__(self, baseline, targets, workers=2, pool=None,
+                 hashcache=None, profile=None):
+        if pool is not None and pool.size < 2:
+            raise ValueError("The pool must hold at least two appliances "
+                             "for the baseline and the targets")
+
+        self.baseline = baseline
+        self.targets = tuple(targets)
+        self.workers = workers
+        self.pool = pool
+        self.hashcache = hashcache
+        self.profile = profile
+        self.filesystem = None
+        self._manifest = None
+        self._manifest_file = None
+        self._registries = {}
+        self._checksums = {}
+        self._lock = threading.Lock()
+        self.logger = logging.getLogger(
+            "%s.%s" % (self.__module__, self.__class__.__name__))
+
+    def __enter__(self):
+        if is_manifest(self.baseline):
+            self._manifest = Manifest(self.baseline)
+        else:
+            self.filesystem = open_filesystem(
+                self.baseline, pool=self.pool, hashcache=self.hashcache,
+                profile=self.profile)
+            self.filesystem.mount()
+
+        return self
+
+    def __exit__(self, *_):
+        if self._manifest is not None:
+            self._manifest.close()
+        if self._manifest_file is not None:
+            self._manifest_file.close()
+        if self.filesystem is not None:
+            self.filesystem.umount()
+
+    def compare(self, identify=False, size=False, registry=False,
+                engine='appliance', dedupe=False, policy=None):
+        """Compares the targets against the baseline.
+
+        See DiskComparator.compare and compare_registry for the keywords.
+
+        Yields the target disks and their report as soon as compared.
+        Targets which cannot be compared are reported with an error.
+
+            '/path/to/target', {'created_files': [...],
+                                'deleted_files': [...],
+                                'modified_files': [...],
+                                'registry': {...}}
+
+        """
+        if registry:
+            self._assert_mounted()
+
+        manifest = self._baseline_manifest(engine, dedupe, policy)
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = {executor.submit(self._compare, t, manifest, identify,
+                                       size, registry, engine, dedupe,
+                                       policy): t for t in self.targets}
+
+            for future in as_completed(futures):
+                try:
+                    yield futures[future], future.result()
+                except RuntimeError as error:
+                    self.logger.warning("Unable to compare %s: %s",
+                                        futures[future], error)
+                    yield futures[future], {'error': str(error)}
+
+    def _baseline_manifest(self, engine, dedupe, policy):
+        """Hashes the baseline once into a temporary manifest."""
+        if self._manifest is None:
+            self.logger.debug("Hashing baseline %s.", self.baseline)
+
+            self._manifest_file = NamedTemporaryFile(suffix='.manifest')
+            create_manifest(self.filesystem, self._manifest_file.name,
+                            engine=engine, dedupe=dedupe, policy=policy)
+            self._manifest = Manifest(self._manifest_file.name)
+
+        return self._manifest
+
+    def _compare(self, target, manifest, identify, size, registry,
+                 engine, dedupe, policy):
+        self.logger.debug("Comparing %s against the baseline.", target)
+
+        with open_filesystem(target, pool=self.pool, hashcache=self.hashcache,
+                             profile=self.profile) as filesystem:
+            differences = manifest_comparison(
+                manifest, filesystem, engine=engine, dedupe=dedupe,
+                policy=policy)
+
+            if identify or size:
+                differences = enrich_differences(
+                    self.filesystem or manifest, filesystem, differences,
+                    identify=identify, size=size)
+
+            results = collect_comparison(differences)
+
+            if registry:
+                results['registry'] = self._compare_registry(filesystem)
+
+        return results
+
+    def _compare_registry(self, filesystem):
+        """Compares the target registry hives which differ from the baseline
+        ones, the baseline hives are parsed only once.
+
+        """
+        if not all(fs.osname == 'windows'
+                   for fs in (self.filesystem, filesystem)):
+            raise RuntimeError("Both disks must contain a Windows File System")
+
+        hives = [p for p in chain(registries_path(self.filesystem.fsroot),
+                                  user_registries(self.filesystem, filesystem))
+                 if self._baseline_checksum(p) != filesystem.checksum(p)]
+
+        baseline = {}
+        for hive in hives:
+            baseline.update(self._baseline_registry(hive))
+
+        return registry_comparison(baseline,
+                                   parse_registries(filesystem, hives))
+
+    def _baseline_checksum(self, path):
+        with self._lock:
+            if path not in self._checksums:
+                self._checksums[path] = self.filesystem.checksum(path)
+
+            return self._checksums[path]
+
+    def _baseline_registry(self, hive):
+        with self._lock:
+            if hive not in self._registries:
+                self._registries[hive] = parse_registries(self.filesystem,
+                                                          (hive, ))
+
+            return self._registries[hive]
+
+    def _assert_mounted(self):
+        if self.filesystem is None:
+            raise RuntimeError("Manifests do not contain the files content")
+
+
+def compare_partitions(disk0, disk1, workers=None, pool=None, hashcache=None,
+                       profile=None, **options):
+    """Compares all the Operating System roots and data file systems
+    found on both disks.
+
+    Partitions are matched by name and compared concurrently,
+    each one by its own DiskComparator. The options are passed
+    to DiskComparator.compare.
+
+    The results are merged tagging each file with its partition
+    and the partitions found on a single disk are reported.
+
+        {'created_files': [{'path': '/file/in/disk1/not/in/disk0',
+                            'sha1': 'sha1_of_the_file',
+                            'partition': '/dev/sda2'}],
+         ...
+         'created_partitions': ['/dev/sda3'],
+         'deleted_partitions': []}
+
+    """
+    partitions0 = disk_partitions(disk0, pool=pool, profile=profile)
+    partitions1 = disk_partitions(disk1, pool=pool, profile=profile)
+
+    def compare_partition(partition):
+        with DiskComparator(disk0, disk1, pool=pool, hashcache=hashcache,
+                            profile=profile,
+                            partition=partition) as comparator:
+            return comparator.compare(**options)
+
+    comparisons = map_partitions(
+        compare_partition, [p for p in partitions0 if p in partitions1],
+        workers)
+
+    results = {key: [dict(f, partition=p)
+                     for p, comparison in comparisons.items()
+                     for f in comparison[key]]
+               for key in ('created_files', 'deleted_files', 'modified_files')}
+    results['created_partitions'] = [p for p in partitions1
+                                     if p not in partitions0]
+    results['deleted_partitions'] = [p for p in partitions0
+                                     if p not in partitions1]
+
+    return results
+
+
+def compare_filesystems(fs0, fs1, concurrent=False, metadata=False,
+                        trust_metadata=False, blocks=False, engine='appliance',
+                        dedupe=False, policy=None):
     """Compares the two given filesystems.
 
     fs0 and fs1 are two mounted GuestFS instances
@@ -181,6 +508,28 @@ def compare_filesystems(fs0, fs1, concurrent=False):
     If the concurrent flag is True,
     two processes will be used speeding up the comparison on multiple CPUs.
 
+    If the metadata flag is True, the two filesystems are walked first
+    and only the files new, deleted or which size, timestamps or inode
+    differ are hashed. Files with identical metadata are deemed unchanged.
+
+    If trust_metadata is True as well, no file is hashed at all:
+    files which metadata differ are reported as modified
+    and the hashes in the report are None.
+
+    Either filesystem can be a Manifest, the files of the other one
+    are then hashed and compared against it.
+    The metadata and blocks flags do not apply to manifests.
+
+    If the blocks flag is True, the allocation maps of disk images sharing
+    a backing file are compared first. Images which do not differ within
+    the mounted partitions result in an empty report without walking
+    the filesystems. Otherwise, or if the images are not related by
+    a backing chain, the comparison proceeds according to the metadata flags:
+    changed blocks are not mapped back to the files owning them.
+
+    The engine and dedupe keywords select how whole filesystems are hashed,
+    see FileSystem.checksums. Files excluded by the policy are ignored.
+
     Returns a dictionary containing files created, removed and modified.
 
         {'created_files': [<files in fs1 and not in fs0>],
@@ -188,19 +537,183 @@ def compare_filesystems(fs0, fs1, concurrent=False):
          'modified_files': [<files in both fs0 and fs1 but different>]}
 
     """
+    return collect_comparison(filesystem_differences(
+        fs0, fs1, concurrent=concurrent, metadata=metadata,
+        trust_metadata=trust_metadata, blocks=blocks, engine=engine,
+        dedupe=dedupe, policy=policy))
+
+
+def filesystem_differences(fs0, fs1, concurrent=False, metadata=False,
+                           trust_metadata=False, blocks=False,
+                           engine='appliance', dedupe=False, policy=None):
+    """Generator counterpart of compare_filesystems.
+
+    Yields the differences as merge_comparison.
+
+    """
+    if isinstance(fs0, Manifest) or isinstance(fs1, Manifest):
+        yield from manifest_comparison(fs0, fs1, engine=engine,
+                                       dedupe=dedupe, policy=policy)
+        return
+
+    if blocks and not images_differ(fs0, fs1):
+        return
+
+    if metadata:
+        comparison = metadata_comparison(fs0, fs1, concurrent=concurrent,
+                                         trust=trust_metadata, policy=policy)
+        yield from ((kind, entry) for kind, entries in comparison.items()
+                    for entry in entries)
+        return
+
+    if concurrent:
+        future0 = concurrent_sorted_checksums(fs0, engine, dedupe, policy)
+        future1 = concurrent_sorted_checksums(fs1, engine, dedupe, policy)
+
+        files0 = future0.result()
+        files1 = future1.result()
+    else:
+        files0 = sorted_checksums(fs0, engine=engine, dedupe=dedupe,
+                                  policy=policy)
+        files1 = sorted_checksums(fs1, engine=engine, dedupe=dedupe,
+                                  policy=policy)
+
+    yield from merge_comparison(files0, files1)
+
+
+def manifest_comparison(fs0, fs1, engine='appliance', dedupe=False,
+                        policy=None):
+    """Compares a Manifest against a mounted FileSystem or another Manifest.
+
+    Two manifests are merge-joined on their raw records,
+    only the differing entries are decoded.
+
+    Yields the differences as merge_comparison.
+
+    """
+    for filesystem in (fs0, fs1):
+        if isinstance(filesystem, Manifest) and filesystem.hashtype != 'sha1':
+            raise ValueError("%s is not a sha1 manifest" % filesystem.disk_path)
+
+    if isinstance(fs0, Manifest) and isinstance(fs1, Manifest) and \
+       policy is None:
+        for kind, entry in merge_comparison(fs0.raw_checksums(),
+                                            fs1.raw_checksums()):
+            yield kind, {k: v.decode('utf8') if k == 'path' else v.hex()
+                         for k, v in entry.items()}
+    else:
+        yield from merge_comparison(
+            *(manifest_checksums(f, engine, dedupe, policy)
+              for f in (fs0, fs1)))
+
+
+def manifest_checksums(filesystem, engine, dedupe, policy):
+    if policy == 'default':
+        policy = default_policy(filesystem.osname)
+
+    if isinstance(filesystem, Manifest):
+        return filesystem.checksums(policy=policy)
+    else:
+        return sorted_checksums(filesystem, engine=engine, dedupe=dedupe,
+                                policy=policy)
+
+
+def images_differ(fs0, fs1):
+    """Compares the disk images of the two filesystems at block level.
+
+    Returns False if no changed block lies within the mounted partitions.
+    Images not sharing a backing file are deemed different,
+    comparing them block by block would read both of them in full.
+
+    """
+    ranges = changed_ranges(fs0.disk_path, fs1.disk_path)
+
+    if ranges == []:
+        return False
+    if ranges is None:
+        return True
+
+    return any(overlapping(ranges, *device_range(fs, device))
+               for fs in (fs0, fs1) for _, device in fs.mountpoints)
+
+
+def device_range(filesystem, device):
+    """Returns the byte range of the device within its disk image."""
+    try:
+        disk = filesystem.part_to_dev(device)
+        number = filesystem.part_to_partnum(device)
+    except RuntimeError:  # Logical Volume or whole disk file system
+        return 0, float('inf')
+
+    partition = next(p for p in filesystem.part_list(disk)
+                     if p['part_num'] == number)
+
+    return partition['part_start'], partition['part_end'] + 1
+
+
+def metadata_comparison(fs0, fs1, concurrent=False, trust=False, policy=None):
+    """Compares the two given filesystems hashing only the files
+    which metadata differ.
+
+    """
+    if concurrent:
+        future0 = concurrent_files_metadata(fs0, policy)
+        future1 = concurrent_files_metadata(fs1, policy)
+
+        metadata0 = future0.result()
+        metadata1 = future1.result()
+    else:
+        metadata0 = files_metadata(fs0, policy=policy)
+        metadata1 = files_metadata(fs1, policy=policy)
+
+    changed = {p for p, m in metadata1.items()
+               if p in metadata0 and m != metadata0[p]}
+    candidates0 = [p for p in metadata0 if p not in metadata1 or p in changed]
+    candidates1 = [p for p in metadata1 if p not in metadata0 or p in changed]
+
+    if trust:
+        return {'created_files': [{'path': p, 'sha1': None}
+                                  for p in candidates1 if p not in changed],
+                'deleted_files': [{'path': p, 'original_sha1': None}
+                                  for p in candidates0 if p not in changed],
+                'modified_files': [{'path': p,
+                                    'original_sha1': None,
+                                    'sha1': None} for p in changed]}
+
     if concurrent:
-        future0 = concurrent_hash_filesystem(fs0)
-        future1 = concurrent_hash_filesystem(fs1)
+        future0 = concurrent_hash_files(fs0, candidates0)
+        future1 = concurrent_hash_files(fs1, candidates1)
 
         files0 = future0.result()
         files1 = future1.result()
     else:
-        files0 = hash_filesystem(fs0)
-        files1 = hash_filesystem(fs1)
+        files0 = hash_files(fs0, candidates0)
+        files1 = hash_files(fs1, candidates1)
 
     return file_comparison(files0, files1)
 
 
+def files_metadata(filesystem, policy=None):
+    """Returns the metadata of the regular files contained in the filesystem.
+
+    Files excluded by the HashPolicy are left out.
+
+        {'/path/on/filesystem': (size, mtime, mtime_nsec,
+                                 ctime, ctime_nsec, inode)}
+
+    """
+    if policy == 'default':
+        policy = default_policy(filesystem.osname)
+
+    return {path: (fstat['st_size'],
+                   fstat['st_mtime_sec'], fstat['st_mtime_nsec'],
+                   fstat['st_ctime_sec'], fstat['st_ctime_nsec'],
+                   fstat['st_ino'])
+            for path, fstat in filesystem.walk('/')
+            if stat.S_ISREG(fstat['st_mode']) and
+            (policy is None or policy.selected(path, fstat['st_size']))}
+
+
 def file_comparison(files0, files1):
     """Compares two dictionaries of files returning their difference.
 
@@ -209,24 +722,53 @@ def file_comparison(files0, files1):
          'modified_files': [<files in both files0 and files1 but different>]}
 
     """
+    return collect_comparison(merge_comparison(sorted(files0.items()),
+                                               sorted(files1.items())))
+
+
+def merge_comparison(files0, files1):
+    """Merge-joins two iterables of (path, sha1) pairs sorted by path.
+
+    Memory usage does not depend on the amount of files.
+
+    Yields the kind of difference and the file as they are found.
+
+        'created_files', {'path': '/file/in/files1', 'sha1': 'sha1'}
+        'deleted_files', {'path': '/file/in/files0', 'original_sha1': 'sha1'}
+        'modified_files', {'path': '/file/in/both',
+                           'original_sha1': 'sha1', 'sha1': 'sha1'}
+
+    """
+    files0 = iter(files0)
+    files1 = iter(files1)
+    file0 = next(files0, None)
+    file1 = next(files1, None)
+
+    while file0 is not None or file1 is not None:
+        if file1 is None or (file0 is not None and file0[0] < file1[0]):
+            yield 'deleted_files', {'path': file0[0],
+                                    'original_sha1': file0[1]}
+            file0 = next(files0, None)
+        elif file0 is None or file1[0] < file0[0]:
+            yield 'created_files', {'path': file1[0], 'sha1': file1[1]}
+            file1 = next(files1, None)
+        else:
+            if file0[1] != file1[1]:
+                yield 'modified_files', {'path': file1[0],
+                                         'original_sha1': file0[1],
+                                         'sha1': file1[1]}
+            file0 = next(files0, None)
+            file1 = next(files1, None)
+
+
+def collect_comparison(differences):
+    """Collects the differences yielded by merge_comparison."""
     comparison = {'created_files': [],
                   'deleted_files': [],
                   'modified_files': []}
 
-    for path, sha1 in files1.items():
-        if path in files0:
-            if sha1 != files0[path]:
-                comparison['modified_files'].append(
-                    {'path': path,
-                     'original_sha1': files0[path],
-                     'sha1': sha1})
-        else:
-            comparison['created_files'].append({'path': path,
-                                                'sha1': sha1})
-    for path, sha1 in files0.items():
-        if path not in files1:
-            comparison['deleted_files'].append({'path': path,
-                                                'original_sha1': files0[path]})
+    for kind, entry in differences:
+        comparison[kind].append(entry)
 
     return comparison
 
@@ -239,7 +781,9 @@ def extract_files(filesystem, files, path):
         {"C:\\Windows\\System32\\NTUSER.DAT": "sha1_hash"} for windows
         {"/home/user/text.txt": "sha1_hash"} for other FS.
 
-    files will be extracted into path which must exist beforehand.
+    files will be extracted into path which must exist beforehand
+    through the bulk extraction engine, files already present
+    in path are not extracted again.
 
     Returns two dictionaries:
 
@@ -247,24 +791,24 @@ def extract_files(filesystem, files, path):
         {"sha1": "C:\\..\\text.txt"} files which could not be extracted windows
         {"sha1": "/../text.txt"} files which could not be extracted linux
 
+    Files compared by metadata only have no sha1,
+    their failures are keyed by path.
+
     """
     extracted_files = {}
     failed_extractions = {}
+    requests = [ExtractionRequest(f['path'], f['sha1'], None) for f in files]
 
-    for file_to_extract in files:
-        source = file_to_extract['path']
-        destination = Path(path, file_to_extract['sha1'])
-
-        if not destination.exists():
-            destination = str(destination)
+    for file_to_extract, result in zip(files, extract(filesystem, requests,
+                                                      path)):
+        if result.error is None:
+            if file_to_extract['sha1'] is None:  # metadata only comparison
+                file_to_extract['sha1'] = result.sha1
 
-            try:
-                filesystem.download(source, destination)
-                extracted_files[file_to_extract['sha1']] = destination
-            except RuntimeError:
-                failed_extractions[file_to_extract['sha1']] = source
+            extracted_files[result.sha1] = result.path
         else:
-            extracted_files[file_to_extract['sha1']] = destination
+            key = file_to_extract['sha1'] or file_to_extract['path']
+            failed_extractions[key] = result.source
 
     return extracted_files, failed_extractions
 
@@ -364,29 +908,86 @@ def user_registries(fs0, fs1):
                 yield path
 
 
+def enrich_differences(fs0, fs1, differences, identify=False, size=False):
+    """Adds type and size to the differences yielded by merge_comparison.
+
+    Differences are enriched in batches by a separate thread
+    while the following batch is being gathered.
+
+    Deleted files are looked up in fs0, the others in fs1.
+
+    """
+    differences = iter(differences)
+    pending = None
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        for batch in iter(lambda: list(islice(differences, ENRICH_BATCH)), []):
+            future = executor.submit(enrich_batch, fs0, fs1, batch,
+                                     identify, size)
+
+            if pending is not None:
+                yield from pending.result()
+
+            pending = future
+
+        if pending is not None:
+            yield from pending.result()
+
+
+def enrich_batch(fs0, fs1, batch, identify, size):
+    files = collect_comparison(batch)
+
+    if identify:
+        files_type(fs0, fs1, files)
+    if size:
+        files_size(fs0, fs1, files)
+
+    return batch
+
+
 def files_type(fs0, fs1, files):
     """Inspects the file type of the given files."""
-    for file_meta in files['deleted_files']:
-        file_meta['type'] = fs0.file(file_meta['path'])
-    for file_meta in files['created_files'] + files['modified_files']:
-        file_meta['type'] = fs1.file(file_meta['path'])
+    for filesystem, files_meta in ((fs0, files['deleted_files']),
+                                   (fs1, files['created_files'] +
+                                    files['modified_files'])):
+        metadata = dict(filesystem.metadata(
+            (f['path'] for f in files_meta), identify=True))
+
+        for file_meta in files_meta:
+            file_meta['type'] = metadata[file_meta['path']].get('type')
 
     return files
 
 
 def files_size(fs0, fs1, files):
     """Gets the file size of the given files."""
-    for file_meta in files['deleted_files']:
-        file_meta['size'] = fs0.stat(file_meta['path'])['size']
-    for file_meta in files['created_files'] + files['modified_files']:
-        file_meta['size'] = fs1.stat(file_meta['path'])['size']
+    for filesystem, files_meta in ((fs0, files['deleted_files']),
+                                   (fs1, files['created_files'] +
+                                    files['modified_files'])):
+        metadata = dict(filesystem.metadata(f['path'] for f in files_meta))
+
+        for file_meta in files_meta:
+            fstat = metadata[file_meta['path']]['stat']
+            file_meta['size'] = fstat['st_size'] if fstat else None
 
     return files
 
 
 @concurrent.thread
-def concurrent_hash_filesystem(filesystem):
-    return hash_filesystem(filesystem)
+def concurrent_sorted_checksums(filesystem, engine='appliance', dedupe=False,
+                                policy=None):
+    return sorted_checksums(filesystem, engine=engine, dedupe=dedupe,
+                            policy=policy)
+
+
+@concurrent.thread
+def concurrent_files_metadata(filesystem, policy=None):
+    return files_metadata(filesystem, policy=policy)
+
+
+@concurrent.thread
+def concurrent_hash_files(filesystem, paths):
+    return hash_files(filesystem, paths)
 
 
 def parse_registries(filesystem, registries):
@@ -421,3 +1022,6 @@ def makedirs(path):
 
     if not path.exists():
         path.mkdir(parents=True)
+
+
+ENRICH_BATCH = 1000
@@ -0,0 +1,313 @@
+# Copyright (c) 2016-2017, Matteo Cafasso
+# All rights reserved.
+
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+
+# 3. Neither the name of the copyright holder nor the names of its contributors
+# may be used to endorse or promote products derived from this software without
+# specific prior written permission.
+
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+# THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS
+# BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY,
+# OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT
+# OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE
+# OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE,
+# EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+
+"""Bulk extraction of files into a content addressed store."""
+
+
+import os
+import time
+import hashlib
+import logging
+import tarfile
+import tempfile
+import posixpath
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from vminspect.filesystem import posix_path
+
+
+class ContentStore:
+    """Content addressed store of files on the host.
+
+    Files are named after their SHA1 hash, optionally followed
+    by a name (<sha1>_<name>). Contents are staged within the store
+    and atomically renamed once hashed, so files already present
+    are never written twice.
+
+    """
+    def __init__(self, path):
+        self.path = path
+
+        os.makedirs(path, exist_ok=True)
+
+    def location(self, digest, name=None):
+        """Returns the path of the content with the given hash."""
+        if name is not None:
+            return os.path.join(self.path, '_'.join((digest, name)))
+        else:
+            return os.path.join(self.path, digest)
+
+    def contains(self, digest, name=None):
+        return os.path.exists(self.location(digest, name))
+
+    def staging(self):
+        """Returns the path of a new staging file within the store."""
+        descriptor, path = tempfile.mkstemp(dir=self.path, prefix='.staging')
+        os.close(descriptor)
+
+        return path
+
+    def commit(self, staging, digest, name=None):
+        """Moves the staged content to its location.
+
+        Returns the location and whether the content was already present.
+
+        """
+        location = self.location(digest, name)
+
+        if os.path.exists(location):
+            os.remove(staging)
+
+            return location, True
+
+        os.replace(staging, location)
+
+        return location, False
+
+
+class Extractor:
+    """Extracts files from a mounted FileSystem into a ContentStore.
+
+    Requested files are deduplicated by source and by known hash,
+    hashes already present in the store are not extracted at all.
+
+    Files requested in bulk from the same folder are streamed out
+    of the appliance within a single tar archive, the others are
+    downloaded one by one while workers threads hash and store
+    the previous ones.
+
+    The statistics attribute reports the extraction throughput.
+
+    """
+    def __init__(self, filesystem, store, workers=None):
+        self.filesystem = filesystem
+        self.store = store
+        self.workers = workers
+        self.statistics = {'files': 0, 'bytes': 0, 'skipped': 0,
+                           'failed': 0, 'seconds': 0.0}
+        self._lock = threading.Lock()
+        self.logger = logging.getLogger(
+            "%s.%s" % (self.__module__, self.__class__.__name__))
+
+    @property
+    def throughput(self):
+        """Returns the extracted bytes per second."""
+        seconds = self.statistics['seconds']
+
+        return self.statistics['bytes'] / seconds if seconds else 0.0
+
+    def extract(self, requests):
+        """Extracts the given ExtractionRequests.
+
+        A request source is either a file path
+        or the inode of a deleted file to be recovered.
+
+        Returns a list of ExtractionResult in the requests order.
+
+        """
+        start = time.monotonic()
+        results = {}
+        pending = []
+
+        for request in requests:
+            if request.source in results:
+                continue
+            if request.sha1 is not None and \
+               self.store.contains(request.sha1, request.name):
+                self.statistics['skipped'] += 1
+                results[request.source] = ExtractionResult(
+                    request.source, request.sha1,
+                    self.store.location(request.sha1, request.name), None)
+            else:
+                results[request.source] = None
+                pending.append(request)
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = []
+
+            for request in self._bulk_requests(pending, results):
+                futures.append((request, executor.submit(
+                    self._store, request, self._download(request))))
+
+            for request, future in futures:
+                results[request.source] = future.result()
+
+        for result in results.values():
+            if result.error is not None:
+                self.statistics['failed'] += 1
+
+        self.statistics['seconds'] += time.monotonic() - start
+        self.logger.debug("Extracted %d files, %d bytes at %.0f bytes/s, "
+                          "%d skipped, %d failed.",
+                          self.statistics['files'], self.statistics['bytes'],
+                          self.throughput, self.statistics['skipped'],
+                          self.statistics['failed'])
+
+        return [results[r.source] for r in requests]
+
+    def _bulk_requests(self, requests, results):
+        """Extracts the files grouped by folder through tar archives.
+
+        Yields the requests left to be downloaded one by one.
+
+        """
+        folders = {}
+
+        for request in requests:
+            if isinstance(request.source, str):
+                folder, name = posixpath.split(posix_path(request.source))
+                folders.setdefault(folder, {})[name] = request
+            else:
+                yield request
+
+        for folder, group in folders.items():
+            if len(group) < BULK_MIN:
+                yield from group.values()
+                continue
+
+            try:
+                for name, result in self._archive(folder, group):
+                    results[group.pop(name).source] = result
+            except RuntimeError as error:
+                self.logger.debug("Unable to archive %s: %s", folder, error)
+
+            yield from group.values()  # not archived
+
+    def _archive(self, folder, group):
+        """Stores the regular files streamed within the folder archive."""
+        with self.filesystem.archive(folder, group) as stream:
+            with tarfile.open(fileobj=stream, mode='r|') as archive:
+                for member in archive:
+                    name = member.name[2:] if member.name.startswith('./') \
+                           else member.name
+
+                    if name in group and member.isreg():
+                        request = group[name]
+                        staging = self.store.staging()
+
+                        try:
+                            with open(staging, 'wb') as staging_file:
+                                digest = copy_hashing(
+                                    archive.extractfile(member), staging_file)
+                        except BaseException:
+                            os.remove(staging)
+                            raise
+
+                        yield name, self._commit(request, staging, digest,
+                                                 member.size)
+
+    def _download(self, request):
+        """Downloads the requested file into a staging file.
+
+        Returns the staging file path or the error.
+
+        """
+        staging = self.store.staging()
+
+        try:
+            if isinstance(request.source, str):
+                self.filesystem.download(request.source, staging)
+            else:
+                self.filesystem.download_inode(
+                    self.filesystem.inspection.root, request.source, staging)
+        except RuntimeError as error:
+            os.remove(staging)
+
+            return error
+
+        return staging
+
+    def _store(self, request, staging):
+        """Hashes the staged file and commits it to the store."""
+        if isinstance(staging, Exception):
+            return ExtractionResult(request.source, request.sha1, None,
+                                    str(staging))
+
+        with open(staging, 'rb') as staging_file:
+            digest = hash_file(staging_file)
+
+        return self._commit(request, staging, digest,
+                            os.path.getsize(staging))
+
+    def _commit(self, request, staging, digest, size):
+        location, present = self.store.commit(staging, digest, request.name)
+
+        with self._lock:
+            if present:
+                self.statistics['skipped'] += 1
+            else:
+                self.statistics['files'] += 1
+                self.statistics['bytes'] += size
+
+        return ExtractionResult(request.source, digest, location, None)
+
+
+def extract(filesystem, requests, path, workers=None):
+    """Extracts the requested files into the content addressed store
+    at the given path.
+
+    Returns a list of ExtractionResult in the requests order.
+
+    """
+    extractor = Extractor(filesystem, ContentStore(path), workers=workers)
+
+    return extractor.extract(requests)
+
+
+def hash_file(fileobj):
+    digest = hashlib.sha1()
+
+    for chunk in iter(lambda: fileobj.read(CHUNK_SIZE), b''):
+        digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+def copy_hashing(source, destination):
+    """Copies source into destination returning the content SHA1."""
+    digest = hashlib.sha1()
+
+    for chunk in iter(lambda: source.read(CHUNK_SIZE), b''):
+        digest.update(chunk)
+        destination.write(chunk)
+
+    return digest.hexdigest()
+
+
+BULK_MIN = 4
+CHUNK_SIZE = 1024 * 1024
+
+
+ExtractionRequest = namedtuple('ExtractionRequest', ('source', 'sha1', 'name'))
+ExtractionResult = namedtuple('ExtractionResult', ('source', 'sha1', 'path',
+                                                   'error'))
@@ -0,0 +1,94 @@
+# Copyright (c) 2016-2017, Matteo Cafasso
+# All rights reserved.
+
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+
+# 3. Neither the name of the copyright holder nor the names of its contributors
+# may be used to endorse or promote products derived from this software without
+# specific prior written permission.
+
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+# THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS
+# BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY,
+# OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT
+# OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE
+# OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE,
+# EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+
+"""External merge sort of iterables not fitting in memory."""
+
+
+import heapq
+import pickle
+from itertools import islice
+from tempfile import TemporaryFile
+
+
+def external_sort(iterable, key=None, buffersize=1000000):
+    """Sorts the iterable keeping at most buffersize items in memory.
+
+    Sorted runs of buffersize items are spilled into temporary files
+    and lazily merged, iterables fitting in the buffer are sorted in memory.
+
+    Returns an iterator over the sorted items.
+
+    """
+    runs = []
+    iterable = iter(iterable)
+
+    for chunk in iter(lambda: list(islice(iterable, buffersize)), []):
+        chunk.sort(key=key)
+
+        if not runs and len(chunk) < buffersize:
+            return iter(chunk)
+
+        runs.append(spill(chunk))
+
+    return merge_runs(runs, key)
+
+
+def spill(items):
+    """Stores the items in a temporary file in blocks of BLOCK_SIZE."""
+    run = TemporaryFile()
+
+    for index in range(0, len(items), BLOCK_SIZE):
+        pickle.dump(items[index:index + BLOCK_SIZE], run,
+                    pickle.HIGHEST_PROTOCOL)
+
+    run.seek(0)
+
+    return run
+
+
+def merge_runs(runs, key=None):
+    """Merges the sorted runs closing them once consumed."""
+    try:
+        yield from heapq.merge(*(read_run(r) for r in runs), key=key)
+    finally:
+        for run in runs:
+            run.close()
+
+
+def read_run(run):
+    while True:
+        try:
+            yield from pickle.load(run)
+        except EOFError:
+            return
+
+
+BLOCK_SIZE = 1000
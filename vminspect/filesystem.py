@@ -33,12 +33,29 @@
 import os
 import re
 import stat
+import time
+import shutil
+import fnmatch
 import logging
-
+import posixpath
+import threading
+import subprocess
+
+from functools import partial
+from operator import itemgetter
+from collections import namedtuple, OrderedDict
+from itertools import count, groupby, islice
 from tempfile import NamedTemporaryFile
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 
 from guestfs import GuestFS
 
+from vminspect.extsort import external_sort
+from vminspect.imagediff import image_size
+from vminspect.hashing import tar_hashes, hash_fileobj
+from vminspect.pipes import appliance_stream, read_records, sparse_copy
+
 
 class FileSystem:
     """Convenience wrapper over GuestFS instance.
@@ -47,12 +64,46 @@ class FileSystem:
 
     Automatically translates paths according to the contained File System.
 
+    If a FileSystemPool is given, the disk is hot-plugged
+    into one of its running appliances instead of launching a new one.
+
+    If a HashCache is given, file hashes are looked up in the cache
+    before reading the files content.
+
+    The statistics attribute counts the files and bytes hashed
+    as well as the bytes skipped as hard links of already hashed files.
+
+    The Operating System information is inspected once at mount time
+    and stored in the inspection attribute.
+
+    profile sets the resources of the appliance, see appliance_profile.
+    It is ignored if a pool is given as the pool appliances are used.
+    Once mounted, the profile attribute holds the applied ApplianceProfile.
+
+    partition selects the Operating System root or the data file system
+    to mount as listed by disk_partitions, by default the first root.
+    Data file systems are mounted on / and their osname is 'unknown'.
+
     """
-    def __init__(self, disk_path):
+    def __init__(self, disk_path, pool=None, hashcache=None, profile=None,
+                 partition=None):
         self._root = None
-        self._handler = GuestFS()
+        self._uuid = None
+        self._cache_key = None
+        self.inspection = None
+        self._pool = pool
+        self._prefix = ''
+        self._drive = None
+        self._handler = None
+        self._appliance = None
 
         self.disk_path = disk_path
+        self.profile = profile
+        self.partition = partition
+        self.hashcache = hashcache
+        self.statistics = {'hashed_files': 0,
+                           'hashed_bytes': 0,
+                           'skipped_bytes': 0}
 
     def __enter__(self):
         self.mount()
@@ -68,32 +119,98 @@ class FileSystem:
     @property
     def osname(self):
         """Returns the Operating System name."""
-        return self._handler.inspect_get_type(self._root)
+        return self.inspection.osname
+
+    @property
+    def uuid(self):
+        """Returns the UUID of the root file system."""
+        if self._uuid is None:
+            self._uuid = self._handler.vfs_uuid(self._root)
+
+        return self._uuid
+
+    @property
+    def cache_key(self):
+        """Returns the identity of the file system within the hash cache.
+
+        File systems without UUID are identified by the disk image path,
+        size and modification time and by the partition.
+        An empty key disables the cache.
+
+        """
+        if self._cache_key is None:
+            self._cache_key = self.uuid or disk_identity(self.disk_path,
+                                                         self.partition)
+
+            if not self._cache_key:
+                logging.warning("%s has no identity, hash cache disabled.",
+                                self.disk_path)
+
+        return self._cache_key
 
     @property
     def fsroot(self):
         """Returns the file system root."""
         if self.osname == 'windows':
-            return '{}:\\'.format(
-                self._handler.inspect_get_drive_mappings(self._root)[0][0])
+            return '{}:\\'.format(self.inspection.drive)
         else:
-            return self._handler.inspect_get_mountpoints(self._root)[0][0]
+            return self.inspection.mountpoints[0][0]
 
-    def mount(self, readonly=True):
+    @property
+    def mountpoints(self):
+        """Returns the (mountpoint, device) pairs of the disk."""
+        return self.inspection.mountpoints
+
+    @property
+    def partitions(self):
+        """Returns the Operating System roots and data file systems
+        of the disk.
+
+        """
+        return filesystem_partitions(self._handler,
+                                     self._appliance.device(self._drive))
+
+    def mount(self, readonly=True, appliance=None):
         """Mounts the given disk.
         It must be called before any other method.
 
+        appliance is an already acquired pool appliance to mount the disk in,
+        see FileSystemPool.acquire_many.
+
         """
-        self._handler.add_drive_opts(self.disk_path, readonly=True)
-        self._handler.launch()
+        if appliance is not None:
+            self._appliance = appliance
+        elif self._pool is not None:
+            self._appliance = self._pool.acquire()
+        else:
+            self._appliance = Appliance(
+                appliance_profile(self.profile, self.disk_path))
+
+        self.profile = self._appliance.profile
+        self._handler = self._appliance.handler
+
+        try:
+            self._drive = self._appliance.attach(self.disk_path)
+            self._appliance.launch()
+            self._mount_drive(readonly)
+        except BaseException:
+            self.umount()
+            raise
+
+    def _mount_drive(self, readonly):
+        """Mounts the file systems of the attached drive under the prefix."""
+        if self._prefix:
+            self._handler.mkmountpoint(self._prefix)
 
         for mountpoint, device in self._inspect_disk():
+            mountpoint = self._guest_path(mountpoint).rstrip('/') or '/'
+
             if readonly:
                 self._handler.mount_ro(device, mountpoint)
             else:
                 self._handler.mount(device, mountpoint)
 
-        if self._handler.inspect_get_type(self._root) == 'windows':
+        if self.inspection.osname == 'windows':
             self.path = self._windows_path
         else:
             self.path = posix_path
@@ -104,124 +221,1519 @@ class FileSystem:
 
         """
         roots = self._handler.inspect_os()
+        disk = self._appliance.device(self._drive)
+
+        if len(self._appliance.drives) > 1:
+            roots = [r for r in roots if disk_device(self._handler, r) == disk]
 
-        if roots:
+        if self.partition is not None:
+            self._root = appliance_device(disk, self.partition)
+
+            if self._root in roots:
+                self.inspection = inspect_root(self._handler, self._root)
+            elif self._root in dict(self._handler.list_filesystems()):
+                self.inspection = Inspection(self._root, 'unknown', None,
+                                             (('/', self._root), ))
+            else:
+                raise RuntimeError("No partition %s on the given disk image."
+                                   % self.partition)
+        elif roots:
             self._root = roots[0]
-            return sorted(self._handler.inspect_get_mountpoints(self._root),
-                          key=lambda m: len(m[0]))
+            self.inspection = inspect_root(self._handler, self._root)
         else:
             raise RuntimeError("No OS found on the given disk image.")
 
+        self.partition = partition_tag(disk, self._root)
+
+        return sorted(self.inspection.mountpoints, key=lambda m: len(m[0]))
+
     def umount(self):
         """Unmounts the disk.
 
         After this method is called no further action is allowed.
 
         """
-        self._handler.close()
+        if self._appliance is None:
+            return
+
+        try:
+            if self._pool is not None:
+                self._pool.release(self._appliance, self._drive)
+            else:
+                self._appliance.release(self._drive)
+        finally:
+            self._drive = None
+            self._handler = None
+            self._appliance = None
 
     def download(self, source, destination):
         """Downloads the file on the disk at source into destination."""
-        self._handler.download(posix_path(source), destination)
+        self._handler.download(self._guest_path(source), destination)
+
+    def download_inode(self, device, inode, destination, sparse=False):
+        """Downloads the file with the given inode on device into destination.
+
+        If sparse is True, the blocks of zeros are not written
+        leaving holes within destination.
+
+        """
+        if sparse:
+            with appliance_stream(self._handler.download_inode,
+                                  device, inode) as stream:
+                written = sparse_copy(stream, destination)
+
+            logging.debug("Inode %d downloaded, %d bytes written.",
+                          inode, written)
+        else:
+            self._handler.download_inode(device, inode, destination)
 
     def ls(self, path):
         """Lists the content at the given path."""
-        return self._handler.ls(posix_path(path))
+        return self._handler.ls(self._guest_path(path))
+
+    @contextmanager
+    def archive(self, directory, names):
+        """Streams out the named nodes of the directory
+        within a single tar archive.
+
+        Subdirectories are archived with their content.
+
+        Yields the archive stream.
+
+        """
+        names = set(names)
+        excludes = [tar_escape(n) for n in self.ls(directory)
+                    if n not in names]
+        function = partial(self._handler.tar_out, excludes=excludes)
+
+        with appliance_stream(function, self._guest_path(directory)) as stream:
+            yield stream
 
     def nodes(self, path):
         """Iterates over the files and directories contained within the disk
         starting from the given path.
 
+        The nodes are listed into a host file and read back lazily,
+        memory usage does not depend on their amount.
+
         Yields the path of the nodes.
 
         """
         path = posix_path(path)
 
-        yield from (self.path(path, e) for e in self._handler.find(path))
+        yield from (self.path(path, e)
+                    for e in self._find(self._guest_path(path)))
+
+    def walk(self, path):
+        """Iterates over the files and directories contained within the disk
+        starting from the given path together with their status.
+
+        The status is retrieved in batches of nodes sharing the same folder.
+
+        Yields the path of the nodes and their lstatns dictionary.
+
+        """
+        path = posix_path(path)
+        guest_path = self._guest_path(path)
+        entries = (posixpath.split(e) for e in self._find(guest_path))
+
+        for directory, group in groupby(entries, key=itemgetter(0)):
+            names = (name for _, name in group)
+
+            for batch in iter(lambda: list(islice(names, STAT_BATCH)), []):
+                stats = self._handler.lstatnslist(
+                    posixpath.join(guest_path, directory), batch)
+
+                yield from ((self.path(path, directory, n), s)
+                            for n, s in zip(batch, stats))
+
+    def metadata(self, paths, identify=False, hashtype=None, xattrs=False):
+        """Retrieves the metadata of the nodes at the given paths.
+
+        The nodes status (and extended attributes if xattrs is True)
+        are fetched in batches of nodes sharing the same folder.
+
+        If identify is True, the node type is reported as the file method.
+        Only regular files are inspected within the appliance,
+        one call per file as libguestfs offers no batched variant.
 
-    def checksum(self, path, hashtype='sha1'):
-        """Returns the checksum of the given path."""
-        return self._handler.checksum(hashtype, posix_path(path))
+        If hashtype is given, the regular files are hashed one call per
+        inode, consulting the hash cache if any. Hash whole trees
+        with checksums or host_checksums instead.
 
-    def checksums(self, path, hashtype='sha1'):
+        Yields the path and a dictionary for each node.
+
+            {'stat': <lstatns dictionary, None if missing>,
+             'type': 'ASCII text', 'hash': 'file_hash', 'xattrs': [...]}
+
+        """
+        paths = iter(paths)
+        links = {}
+
+        for chunk in iter(lambda: list(islice(paths, BULK_BATCH)), []):
+            results = self._bulk_status(chunk, xattrs)
+
+            for path in chunk:
+                meta = results[path]
+                fstat = meta['stat']
+
+                if fstat is not None and (identify or hashtype is not None):
+                    self._inspect_node(path, meta, identify, hashtype, links)
+
+                yield path, meta
+
+    def _bulk_status(self, paths, xattrs):
+        """Retrieves the status of the paths one folder at a time."""
+        results = {}
+        directories = {}
+
+        for path in paths:
+            directory, name = posixpath.split(self._guest_path(path))
+            directories.setdefault(directory, []).append((path, name))
+
+        for directory, entries in directories.items():
+            for index in range(0, len(entries), STAT_BATCH):
+                batch = entries[index:index + STAT_BATCH]
+                names = [n for _, n in batch]
+                stats = self._handler.lstatnslist(directory, names)
+
+                for (path, _), fstat in zip(batch, stats):
+                    results[path] = {'stat': fstat if fstat['st_ino'] >= 0
+                                     else None}
+
+                if xattrs:
+                    self._bulk_xattrs(directory, batch, results)
+
+        return results
+
+    def _bulk_xattrs(self, directory, batch, results):
+        """lxattrlist returns a flat list of attributes where each node
+        is introduced by an entry with empty name and the count as value.
+
+        """
+        attributes = iter(self._handler.lxattrlist(
+            directory, [n for _, n in batch]))
+
+        for (path, _), header in zip(batch, attributes):
+            count = int(header['attrval'] or 0)
+
+            results[path]['xattrs'] = [(a['attrname'], a['attrval'])
+                                       for a in islice(attributes, count)]
+
+    def _inspect_node(self, path, meta, identify, hashtype, links):
+        fstat = meta['stat']
+        regular = stat.S_ISREG(fstat['st_mode'])
+
+        try:
+            if identify:
+                meta['type'] = (self.file(path) if regular
+                                else node_type(fstat['st_mode']))
+
+            if hashtype is not None and regular:
+                inode = fstat['st_ino']
+
+                if inode in links:
+                    meta['hash'] = links[inode]
+                else:
+                    meta['hash'] = self.checksum(path, hashtype, fstat=fstat)
+
+                if fstat['st_nlink'] > 1:
+                    links[inode] = meta['hash']
+        except RuntimeError:
+            logging.debug("Unable to inspect %s.", path)
+
+    def _find(self, path):
+        """Iterates over the relative paths of the nodes
+        under the appliance path.
+
+        The handle serves one call at a time, the listing is spooled
+        into a host file before the callers query the nodes and then
+        read lazily from it.
+
+        """
+        with NamedTemporaryFile() as listing:
+            self._handler.find0(path, listing.name)
+
+            yield from (r.decode('utf8') for r in read_records(listing))
+
+    def checksum(self, path, hashtype='sha1', fstat=None):
+        """Returns the checksum of the given path.
+
+        fstat is the file lstatns dictionary if already known,
+        it is used to look up the hash cache.
+
+        """
+        if self.hashcache is None or not self.cache_key:
+            return self._digest(path, hashtype)
+
+        if fstat is None:
+            fstat = self._lstatns(path)
+
+        digest = self.hashcache.lookup(self.cache_key, fstat, hashtype)
+
+        if digest is None:
+            digest = self._digest(path, hashtype)
+            self.hashcache.store(self.cache_key, fstat, hashtype, digest)
+
+        return digest
+
+    def _digest(self, path, hashtype):
+        return self._handler.checksum(hashtype, self._guest_path(path))
+
+    def _lstatns(self, path):
+        return self._handler.lstatns(self._guest_path(path))
+
+    def checksums(self, path, hashtype='sha1', engine='appliance',
+                  dedupe=False, policy=None):
         """Iterates over the files hashes contained within the disk
         starting from the given path.
 
         The hashtype keyword allows to choose the file hashing algorithm.
 
+        The engine keyword selects where files are hashed:
+        'appliance' hashes them within the appliance,
+        'host' streams them out and hashes them with all the host CPUs.
+
+        If dedupe is True, files are hashed one by one within the appliance
+        and hard linked files (such as Windows WinSxS components)
+        are hashed only once. The host engine always does so.
+
+        policy is a HashPolicy, or 'default' for the profile matching
+        the disk Operating System, selecting the files to be hashed.
+        Within the appliance, policies are applied before reading the files.
+
+        The appliance engine hashes the whole tree in a single call
+        unless a policy, dedupe or a hash cache is given: files are then
+        hashed one call per file, which is far slower on large trees.
+        The host engine applies policies and dedupe on the streamed archive.
+
         Yields the following values:
 
             "C:\\Windows\\System32\\NTUSER.DAT", "hash" for windows
             "/home/user/text.txt", "hash" for other FS
 
         """
+        if policy == 'default':
+            policy = default_policy(self.osname)
+
+        if engine == 'host':
+            yield from ((p, h[hashtype]) for p, h in self.host_checksums(
+                path, (hashtype, ), policy=policy))
+            return
+        if self.hashcache is not None or dedupe or policy is not None:
+            yield from self._walk_checksums(path, hashtype, policy)
+            return
+
         with NamedTemporaryFile(buffering=0) as tempfile:
-            self._handler.checksums_out(hashtype, posix_path(path),
+            self._handler.checksums_out(hashtype, self._guest_path(path),
                                         tempfile.name)
 
             yield from ((self.path(f[1].lstrip('.')), f[0])
                         for f in (l.decode('utf8').strip().split(None, 1)
                                   for l in tempfile))
 
+    def host_checksums(self, path, hashtypes=('sha1', ), workers=None,
+                       policy=None):
+        """Iterates over the files hashes contained within the disk
+        starting from the given path hashing them on the host.
+
+        The content is streamed out of the appliance once
+        and all the hashtypes algorithms are computed in the same pass
+        by workers processes, by default one per CPU.
+
+        Files excluded by the HashPolicy are streamed but not hashed.
+
+        Yields the following values:
+
+            "C:\\Windows\\System32\\NTUSER.DAT", {"sha1": "hash"} for windows
+            "/home/user/text.txt", {"sha1": "hash"} for other FS
+
+        """
+        path = posix_path(path)
+        select = (None if policy is None else
+                  lambda n, s: policy.selected(self.path(path, n), s))
+
+        yield from ((self.path(path, n), h) for n, h in tar_hashes(
+            self._handler, self._guest_path(path), hashtypes, workers,
+            select=select))
+
+    def _walk_checksums(self, path, hashtype, policy=None):
+        """Hashes the regular files one by one.
+
+        Each inode (MFT record on NTFS) is hashed once,
+        its hash is reused for all the hard links pointing to it.
+
+        """
+        links = {}
+
+        for node, fstat in self.walk(path):
+            if not stat.S_ISREG(fstat['st_mode']):
+                continue
+            if policy is not None and not policy.selected(node,
+                                                          fstat['st_size']):
+                continue
+
+            if fstat['st_nlink'] > 1 and fstat['st_ino'] in links:
+                self.statistics['skipped_bytes'] += fstat['st_size']
+                yield node, links[fstat['st_ino']]
+                continue
+
+            try:
+                digest = self.checksum(node, hashtype, fstat=fstat)
+            except RuntimeError:
+                logging.debug("Unable to hash %s.", node)
+                continue
+
+            self.statistics['hashed_files'] += 1
+            self.statistics['hashed_bytes'] += fstat['st_size']
+
+            if fstat['st_nlink'] > 1:
+                links[fstat['st_ino']] = digest
+
+            yield node, digest
+
     def stat(self, path):
         """Retrieves the status of the node at the given path.
 
         Returns a dictionary.
 
         """
-        return self._handler.stat(posix_path(path))
+        return self._handler.stat(self._guest_path(path))
 
     def file(self, path):
         """Analogous to Unix file command.
         Returns the type of node at the given path.
 
         """
-        return self._handler.file(posix_path(path))
+        return self._handler.file(self._guest_path(path))
 
     def exists(self, path):
         """Returns whether the path exists."""
-        return self._handler.exists(posix_path(path))
+        return self._handler.exists(self._guest_path(path))
 
     def path(self, *segments):
         """Normalizes the path returned by guestfs in the File System format."""
         raise NotImplementedError("FileSystem needs to be mounted first")
 
+    def _guest_path(self, path):
+        """Translates the path into the one seen within the appliance."""
+        return self._prefix + posix_path(path)
+
     def _windows_path(self, *segments):
-        drive = self._handler.inspect_get_drive_mappings(self._root)[0][0]
+        return "%s:%s" % (self.inspection.drive,
+                          os.path.join(*segments).replace('/', '\\'))
+
+
+class LocalFileSystem(FileSystem):
+    """FileSystem backend over a directory of the host.
+
+    Serves trees already mounted (such as loop mounted partitions)
+    or extracted on the host without launching any appliance.
+
+    Nodes are listed through os.scandir and os.stat
+    and files are hashed by workers threads, by default one per CPU.
+
+    The Operating System is deemed Windows if the tree contains
+    a Windows/System32 folder, its paths are then reported on drive C.
+
+    """
+    def __init__(self, disk_path, hashcache=None, workers=None):
+        super().__init__(disk_path, hashcache=hashcache)
+        self.workers = workers
+
+    @property
+    def uuid(self):
+        """Returns the real path of the directory."""
+        if self._uuid is None:
+            self._uuid = os.path.realpath(self.disk_path)
+
+        return self._uuid
+
+    def mount(self, readonly=True):
+        """Inspects the directory.
+        It must be called before any other method.
+
+        """
+        if not os.path.isdir(self.disk_path):
+            raise RuntimeError("%s is not a directory." % self.disk_path)
+
+        self.partition = '/'
+
+        if windows_tree(self.disk_path):
+            self.inspection = Inspection(self.disk_path, 'windows', 'C',
+                                         (('/', self.disk_path), ))
+            self.path = self._windows_path
+        else:
+            self.inspection = Inspection(self.disk_path, 'linux', None,
+                                         (('/', self.disk_path), ))
+            self.path = posix_path
+
+    def umount(self):
+        """Nothing to release, kept for API compatibility."""
+        pass
+
+    @property
+    def partitions(self):
+        """The directory is the only partition, named /."""
+        return ['/']
+
+    @contextmanager
+    def archive(self, directory, names):
+        raise RuntimeError("Directories are not archived, copy the files.")
+        yield
+
+    def download(self, source, destination):
+        """Copies the file at source into destination."""
+        with host_errors():
+            shutil.copyfile(self._host_path(source), destination)
+
+    def ls(self, path):
+        """Lists the content at the given path."""
+        with host_errors():
+            return sorted(os.listdir(self._host_path(path)))
+
+    def nodes(self, path):
+        """Iterates over the files and directories contained within the tree
+        starting from the given path.
+
+        Yields the path of the nodes.
+
+        """
+        path = posix_path(path)
+
+        yield from (self.path(path, r) for r, _ in self._scan(path))
+
+    def walk(self, path):
+        """Iterates over the files and directories contained within the tree
+        starting from the given path together with their status.
+
+        Yields the path of the nodes and their lstatns dictionary.
+
+        """
+        path = posix_path(path)
+
+        for relative, entry in self._scan(path):
+            try:
+                status = entry.stat(follow_symlinks=False)
+            except OSError:
+                continue  # removed while walking
+
+            yield self.path(path, relative), lstatns(status)
+
+    def _scan(self, path):
+        """Yields the relative paths and the os.DirEntry of the nodes
+        under path in depth first order.
+
+        """
+        folders = ['']
+
+        while folders:
+            folder = folders.pop()
+
+            try:
+                with os.scandir(self._host_path(path, folder)) as entries:
+                    entries = sorted(entries, key=lambda e: e.name)
+            except OSError as error:
+                logging.debug("Unable to list %s: %s", folder, error)
+                continue
+
+            for entry in entries:
+                relative = posixpath.join(folder, entry.name)
+
+                yield relative, entry
+
+                if entry.is_dir(follow_symlinks=False):
+                    folders.append(relative)
+
+    def _bulk_status(self, paths, xattrs):
+        results = {}
+
+        for path in paths:
+            host_path = self._host_path(path)
+
+            try:
+                results[path] = {'stat': lstatns(os.lstat(host_path))}
+            except OSError:
+                results[path] = {'stat': None}
+                continue
+
+            if xattrs:
+                results[path]['xattrs'] = host_xattrs(host_path)
+
+        return results
+
+    def checksums(self, path, hashtype='sha1', engine='host',
+                  dedupe=True, policy=None):
+        """Iterates over the files hashes contained within the tree
+        starting from the given path.
+
+        Files are read and hashed by the workers threads,
+        hard linked files are hashed only once.
+        The engine and dedupe keywords are ignored.
+
+        policy is a HashPolicy, or 'default' for the profile matching
+        the Operating System, selecting the files to be hashed.
+
+        """
+        if policy == 'default':
+            policy = default_policy(self.osname)
+
+        links = {}
+        files = ((n, s) for n, s in self.walk(path)
+                 if stat.S_ISREG(s['st_mode']) and
+                 (policy is None or policy.selected(n, s['st_size'])))
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for batch in iter(lambda: list(islice(files, STAT_BATCH)), []):
+                unique = {}
+
+                for node, fstat in batch:
+                    key = inode_key(node, fstat)
+
+                    if key not in links:
+                        unique.setdefault(key, (node, fstat))
+
+                digests = dict(zip(unique, executor.map(
+                    lambda f: self._hash_node(f, hashtype), unique.values())))
+
+                for node, fstat in batch:
+                    key = inode_key(node, fstat)
+                    digest = links.get(key, digests.get(key))
+
+                    if digest is None:
+                        continue
+                    if unique.get(key, (None, ))[0] == node:
+                        self.statistics['hashed_files'] += 1
+                        self.statistics['hashed_bytes'] += fstat['st_size']
+                    else:
+                        self.statistics['skipped_bytes'] += fstat['st_size']
+
+                    if fstat['st_nlink'] > 1:
+                        links[key] = digest
+
+                    yield node, digest
+
+    def host_checksums(self, path, hashtypes=('sha1', ), workers=None,
+                       policy=None):
+        """Iterates over the files hashes contained within the tree
+        starting from the given path, all the hashtypes algorithms
+        are computed in the same pass by workers threads.
+
+        """
+        files = (n for n, s in self.walk(path)
+                 if stat.S_ISREG(s['st_mode']) and
+                 (policy is None or policy.selected(n, s['st_size'])))
+
+        with ThreadPoolExecutor(max_workers=workers or self.workers) as pool:
+            for batch in iter(lambda: list(islice(files, STAT_BATCH)), []):
+                hashes = pool.map(lambda n: self._hash_file(n, hashtypes),
+                                  batch)
+
+                yield from ((n, h) for n, h in zip(batch, hashes)
+                            if h is not None)
+
+    def _hash_node(self, node, hashtype):
+        path, fstat = node
+
+        try:
+            return self.checksum(path, hashtype, fstat=fstat)
+        except RuntimeError:
+            logging.debug("Unable to hash %s.", path)
+
+    def _hash_file(self, path, hashtypes):
+        try:
+            with open(self._host_path(path), 'rb') as fileobj:
+                return hash_fileobj(fileobj, hashtypes)
+        except OSError:
+            logging.debug("Unable to hash %s.", path)
+
+    def _digest(self, path, hashtype):
+        with host_errors(), open(self._host_path(path), 'rb') as fileobj:
+            return hash_fileobj(fileobj, (hashtype, ))[hashtype]
+
+    def _lstatns(self, path):
+        with host_errors():
+            return lstatns(os.lstat(self._host_path(path)))
+
+    def stat(self, path):
+        """Retrieves the status of the node at the given path.
+
+        Returns a dictionary with the same keys of GuestFS.stat.
+
+        """
+        with host_errors():
+            status = os.stat(self._host_path(path))
+
+        return {k: int(getattr(status, 'st_' + k)) for k in STAT_FIELDS}
+
+    def file(self, path):
+        """Analogous to Unix file command.
+        Returns the type of node at the given path.
+
+        """
+        host_path = self._host_path(path)
+
+        with host_errors():
+            mode = os.lstat(host_path).st_mode
+
+            if not stat.S_ISREG(mode):
+                return node_type(mode)
+
+            try:
+                output = subprocess.check_output(('file', '-zb', host_path))
+            except subprocess.CalledProcessError as error:
+                raise RuntimeError(error)
+
+        return output.decode('utf8').strip()
+
+    def exists(self, path):
+        """Returns whether the path exists."""
+        return os.path.exists(self._host_path(path))
+
+    def filesystem_walk(self, device):
+        """Emulates GuestFS.filesystem_walk over the directory.
+
+        Only allocated nodes are reported, as deleted ones are not visible,
+        the creation time is available only where the host provides it.
+
+        """
+        for relative, entry in self._scan('/'):
+            try:
+                status = entry.stat(follow_symlinks=False)
+            except OSError:
+                continue
+
+            dirent = {'tsk_inode': status.st_ino,
+                      'tsk_name': relative,
+                      'tsk_size': status.st_size,
+                      'tsk_type': tsk_type(status.st_mode),
+                      'tsk_flags': 0x01}
+
+            for name in ('atime', 'mtime', 'ctime'):
+                dirent.update(timespec('tsk_' + name,
+                                       getattr(status, 'st_%s_ns' % name)))
+
+            birthtime = getattr(status, 'st_birthtime', 0)
+            dirent.update(timespec('tsk_crtime', int(birthtime * 10**9)))
 
-        return "%s:%s" % (drive, os.path.join(*segments).replace('/', '\\'))
+            yield dirent
 
+    def download_inode(self, device, inode, destination, sparse=False):
+        raise RuntimeError("Inode download requires a disk image.")
 
-def hash_filesystem(filesystem, hashtype='sha1'):
+    def _host_path(self, *segments):
+        """Translates the path into the one seen on the host."""
+        return os.path.join(self.disk_path,
+                            posix_path(*segments).lstrip('/'))
+
+
+class HashPolicy:
+    """Selects the files to be hashed.
+
+    include and exclude are lists of glob patterns matched against
+    the POSIX form of the file path (C:\\Windows\\win.ini -> /Windows/win.ini).
+    If include is given, only the matching files are hashed.
+
+    Files bigger than maxsize bytes are skipped.
+
+    Unless special is True, page, hibernation and swap files are skipped.
+
+    If ignorecase is True, patterns are matched case insensitively.
+
+    """
+    def __init__(self, include=(), exclude=(), maxsize=None,
+                 special=False, ignorecase=False):
+        self.maxsize = maxsize
+        self.special = special
+        self.ignorecase = ignorecase
+        self.include = tuple(self._normalize(p) for p in include)
+        self.exclude = tuple(self._normalize(p) for p in exclude)
+
+        if not special:
+            self.exclude += tuple(self._normalize(p) for p in SPECIAL_FILES)
+
+    def __repr__(self):
+        return "%s(include=%s, exclude=%s, maxsize=%s)" % (
+            self.__class__.__name__, self.include, self.exclude, self.maxsize)
+
+    def selected(self, path, size=None):
+        """Returns True if the file at path of the given size
+        is to be hashed.
+
+        """
+        if self.maxsize is not None and size is not None and \
+           size > self.maxsize:
+            return False
+
+        path = self._normalize(posix_path(path))
+
+        if self.include and not any(fnmatch.fnmatchcase(path, p)
+                                    for p in self.include):
+            return False
+
+        return not any(fnmatch.fnmatchcase(path, p) for p in self.exclude)
+
+    def _normalize(self, string):
+        return string.lower() if self.ignorecase else string
+
+
+def default_policy(osname):
+    """Returns the default HashPolicy for the given Operating System."""
+    if osname == 'windows':
+        return HashPolicy(exclude=WINDOWS_EXCLUDE, maxsize=DEFAULT_MAXSIZE,
+                          ignorecase=True)
+    else:
+        return HashPolicy(exclude=LINUX_EXCLUDE, maxsize=DEFAULT_MAXSIZE)
+
+
+class Appliance:
+    """Wraps a GuestFS handle and the drives attached to it.
+
+    Drives added before launch are attached normally,
+    once the appliance is running they are hot-plugged.
+
+    The uses attribute counts the drives served during the appliance life.
+
+    The ApplianceProfile sets the virtual CPUs and memory of the appliance
+    and the cache options of its drives, None values keep the defaults.
+
+    """
+    def __init__(self, profile=None):
+        self.uses = 0
+        self.drives = {}
+        self.handler = GuestFS()
+        self.profile = profile or PROFILES['default']
+        self.last_used = time.monotonic()
+        self._labels = count()
+
+        if self.profile.smp is not None:
+            self.handler.set_smp(self.profile.smp)
+        if self.profile.memsize is not None:
+            self.handler.set_memsize(self.profile.memsize)
+
+    @property
+    def launched(self):
+        return not self.handler.is_config()
+
+    def launch(self):
+        """Launches the appliance if not already running."""
+        if not self.launched:
+            self.handler.launch()
+
+    def attach(self, disk_path):
+        """Adds the disk as read only drive, returns the drive label."""
+        label = 'vmi%d' % next(self._labels)
+
+        options = {k: v for k, v in (('cachemode', self.profile.cachemode),
+                                     ('copyonread', self.profile.copyonread))
+                   if v is not None}
+
+        self.handler.add_drive_opts(disk_path, readonly=True, label=label,
+                                    **options)
+        self.drives[label] = disk_path
+        self.uses += 1
+
+        return label
+
+    def device(self, label):
+        """Returns the block device of the drive with the given label."""
+        return dict(self.handler.list_disk_labels())[label]
+
+    def release(self, label):
+        """Forgets the drive, the appliance is closed with the last one."""
+        self.drives.pop(label, None)
+
+        if not self.drives:
+            self.close()
+
+    def detach(self, label):
+        """Unmounts the file systems and hot-unplugs the drive."""
+        self.handler.umount_all()
+        self.handler.remove_drive(label)
+        self.drives.pop(label)
+        self.last_used = time.monotonic()
+
+    def close(self):
+        self.handler.close()
+
+
+class FileSystemPool:
+    """Pool of running libguestfs appliances.
+
+    Launching an appliance takes several seconds,
+    the pool keeps up to size appliances running and hot-plugs the disks
+    into them as FileSystem objects are mounted.
+
+    Appliances idle for more than idle_timeout seconds are shut down,
+    maxuses limits the amount of disks served by a single appliance.
+
+    Drive hot-plugging requires the libvirt backend
+    (LIBGUESTFS_BACKEND=libvirt).
+
+    The appliances are launched with the given profile,
+    'auto' sizes them on the host resources only.
+
+    """
+    def __init__(self, size=2, idle_timeout=300, maxuses=None, profile=None):
+        self.size = size
+        self.profile = appliance_profile(profile)
+        self.maxuses = maxuses
+        self.idle_timeout = idle_timeout
+        self._idle = []
+        self._busy = set()
+        self._reserved = 0
+        self._closed = False
+        self._condition = threading.Condition()
+        self.logger = logging.getLogger(
+            "%s.%s" % (self.__module__, self.__class__.__name__))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    @property
+    def stats(self):
+        """Returns the reuse counters of the running appliances."""
+        with self._condition:
+            return {'idle': [a.uses for a in self._idle],
+                    'busy': [a.uses for a in self._busy]}
+
+    def filesystem(self, disk_path):
+        """Returns a FileSystem which will be mounted within the pool."""
+        return FileSystem(disk_path, pool=self)
+
+    def acquire(self):
+        """Returns a running appliance, blocks if the pool is exhausted."""
+        return self.acquire_many(1)[0]
+
+    def acquire_many(self, count):
+        """Returns count running appliances at once,
+        blocks until as many are available.
+
+        Acquiring them together prevents the deadlock of two holders
+        waiting on each other for their second appliance.
+
+        New appliances are launched outside the pool lock
+        within slots reserved for them.
+
+        """
+        if count > self.size:
+            raise ValueError("Cannot acquire %d appliances from a pool of %d"
+                             % (count, self.size))
+
+        with self._condition:
+            expired = self._evict()
+
+            while not self._closed and \
+                  len(self._busy) + self._reserved + count > self.size:
+                self._condition.wait()
+
+            if self._closed:
+                raise RuntimeError("FileSystemPool is closed")
+
+            appliances = [self._idle.pop()
+                          for _ in range(min(count, len(self._idle)))]
+            launches = count - len(appliances)
+            self._busy.update(appliances)
+            self._reserved += launches
+
+        close_appliances(expired)
+
+        launched = []
+
+        try:
+            for _ in range(launches):
+                self.logger.debug("Launching new appliance.")
+
+                appliance = Appliance(self.profile)
+                launched.append(appliance)
+                appliance.launch()
+        except BaseException:
+            close_appliances(launched)
+
+            with self._condition:
+                self._reserved -= launches
+                self._busy.difference_update(appliances)
+                self._idle.extend(appliances)
+                self._condition.notify_all()
+
+            raise
+
+        with self._condition:
+            self._reserved -= launches
+            self._busy.update(launched)
+
+        return appliances + launched
+
+    def release(self, appliance, label):
+        """Detaches the drive and returns the appliance to the pool.
+
+        label is None if no drive was attached.
+
+        """
+        expired = []
+
+        try:
+            if label is not None:
+                appliance.detach(label)
+        except Exception as error:
+            self.logger.warning("Unable to detach drive: %s", error)
+            expired.append(appliance)
+        else:
+            appliance.last_used = time.monotonic()
+
+            if self.maxuses is not None and appliance.uses >= self.maxuses:
+                expired.append(appliance)
+
+        with self._condition:
+            self._busy.discard(appliance)
+
+            if self._closed and appliance not in expired:
+                expired.append(appliance)
+            elif appliance not in expired:
+                self._idle.append(appliance)
+
+            expired.extend(self._evict())
+            self._condition.notify_all()
+
+        close_appliances(expired)
+
+    def close(self):
+        """Shuts down the idle appliances.
+
+        Busy ones are closed as soon as released.
+
+        """
+        with self._condition:
+            self._closed = True
+            expired = self._idle
+            self._idle = []
+            self._condition.notify_all()
+
+        close_appliances(expired)
+
+    def _evict(self):
+        """Removes the appliances idle for too long returning them."""
+        now = time.monotonic()
+        expired = [a for a in self._idle
+                   if now - a.last_used > self.idle_timeout]
+
+        for appliance in expired:
+            self.logger.debug("Closing idle appliance.")
+
+            self._idle.remove(appliance)
+
+        return expired
+
+
+def close_appliances(appliances):
+    for appliance in appliances:
+        try:
+            appliance.close()
+        except RuntimeError as error:
+            logging.debug("Unable to close appliance: %s", error)
+
+
+def shared_filesystems(*disk_paths, readonly=True, hashcache=None,
+                       profile=None, partition=None):
+    """Mounts the given disks within a single appliance.
+
+    Each disk is mounted under its own prefix (/disk0, /disk1, ...)
+    sparing the memory and the boot time of one appliance per disk.
+
+    Returns a tuple of mounted FileSystem objects sharing the same handle.
+    The appliance is shut down once all of them are unmounted.
+
+    The 'auto' profile sizes the appliance on all the disks.
+
+    If partition is given, the same partition is mounted for all the disks.
+
+    """
+    appliance = Appliance(appliance_profile(profile, *disk_paths))
+    filesystems = tuple(FileSystem(d, hashcache=hashcache, partition=partition)
+                        for d in disk_paths)
+
+    try:
+        for index, filesystem in enumerate(filesystems):
+            filesystem._prefix = '/disk%d' % index
+            filesystem.profile = appliance.profile
+            filesystem._appliance = appliance
+            filesystem._handler = appliance.handler
+            filesystem._drive = appliance.attach(filesystem.disk_path)
+
+        appliance.launch()
+
+        for filesystem in filesystems:
+            filesystem._mount_drive(readonly)
+    except RuntimeError:
+        appliance.close()
+        raise
+
+    return filesystems
+
+
+def open_filesystem(disk_path, pool=None, hashcache=None, profile=None,
+                    partition=None):
+    """Returns the FileSystem backend suited for the given path.
+
+    Directories of the host are served by LocalFileSystem,
+    disk images by FileSystem.
+
+    """
+    if os.path.isdir(disk_path):
+        return LocalFileSystem(disk_path, hashcache=hashcache)
+    else:
+        return FileSystem(disk_path, pool=pool, hashcache=hashcache,
+                          profile=profile, partition=partition)
+
+
+def disk_partitions(disk_path, pool=None, profile=None):
+    """Returns the Operating System roots and data file systems
+    of the given disk.
+
+    Partitions are named as if the disk was the first drive (/dev/sda1),
+    Logical Volumes by their canonical name (/dev/vg/lv).
+    Directories of the host are a single partition named /.
+
+    """
+    if os.path.isdir(disk_path):
+        return ['/']
+
+    if pool is not None:
+        appliance = pool.acquire()
+    else:
+        appliance = Appliance(appliance_profile(profile, disk_path))
+
+    label = appliance.attach(disk_path)
+
+    try:
+        appliance.launch()
+
+        return filesystem_partitions(appliance.handler,
+                                     appliance.device(label))
+    finally:
+        if pool is not None:
+            pool.release(appliance, label)
+        else:
+            appliance.release(label)
+
+
+def map_partitions(function, partitions, workers=None):
+    """Calls function with each of the given partitions
+    within up to workers threads, by default one per partition.
+
+    Partitions raising RuntimeError, such as the ones which cannot
+    be mounted, are logged and left out.
+
+    Returns an OrderedDict.
+
+        {'/dev/sda1': <function result>}
+
+    """
+    results = OrderedDict()
+
+    if not partitions:
+        return results
+
+    with ThreadPoolExecutor(max_workers=workers or len(partitions)) as pool:
+        futures = [(p, pool.submit(function, p)) for p in partitions]
+
+        for partition, future in futures:
+            try:
+                results[partition] = future.result()
+            except RuntimeError as error:
+                logging.warning("Unable to process partition %s: %s",
+                                partition, error)
+
+    return results
+
+
+def hash_partitions(disk_path, hashtype='sha1', engine='appliance',
+                    dedupe=False, policy=None, workers=None, pool=None,
+                    hashcache=None, profile=None):
+    """Hashes the files of all the Operating System roots and data
+    file systems of the disk.
+
+    Each partition is mounted within its own appliance
+    and processed concurrently with the others.
+
+    Returns an OrderedDict.
+
+        {'/dev/sda1': {'/path/on/filesystem': 'file_hash'}}
+
+    """
+    def hash_partition(partition):
+        with open_filesystem(disk_path, pool=pool, hashcache=hashcache,
+                             profile=profile,
+                             partition=partition) as filesystem:
+            return hash_filesystem(filesystem, hashtype=hashtype,
+                                   engine=engine, dedupe=dedupe,
+                                   policy=policy)
+
+    return map_partitions(hash_partition,
+                          disk_partitions(disk_path, pool, profile), workers)
+
+
+def filesystem_partitions(handler, disk):
+    """Lists the Operating System roots and the data file systems
+    which do not belong to any root within the given disk.
+
+    """
+    roots = [r for r in handler.inspect_os() if disk_device(handler, r) == disk]
+    mounted = set(d for r in roots
+                  for d in dict(handler.inspect_get_mountpoints(r)).values())
+    data = [d for d, t in sorted(dict(handler.list_filesystems()).items())
+            if t not in NON_DATA_FILESYSTEMS and d not in mounted
+            and disk_device(handler, d) == disk]
+
+    return [partition_tag(disk, d) for d in roots + data]
+
+
+def partition_tag(disk, device):
+    """Names the device as if its disk was the first drive."""
+    if device.startswith(disk):
+        return FIRST_DRIVE + device[len(disk):]
+
+    return device
+
+
+def appliance_device(disk, tag):
+    """Translates the partition tag into the device within the appliance."""
+    if tag.startswith(FIRST_DRIVE):
+        return disk + tag[len(FIRST_DRIVE):]
+
+    return tag
+
+
+def appliance_profile(profile, *disk_paths):
+    """Returns the ApplianceProfile matching the given profile.
+
+    profile can be an ApplianceProfile, None or the name of a profile:
+
+        'default': libguestfs defaults.
+        'readonly': drive options suited for read only inspection,
+                    the host page cache is used without flushing
+                    and backing images blocks are cached in the overlay.
+        'auto': 'readonly' with CPUs and memory sized on the amount
+                of data within the given disks and the host resources.
+
+    """
+    if profile is None:
+        return PROFILES['default']
+    elif isinstance(profile, ApplianceProfile):
+        return profile
+    elif profile == 'auto':
+        return auto_profile(*disk_paths)
+    elif profile in PROFILES:
+        return PROFILES[profile]
+    else:
+        raise ValueError("Unknown appliance profile %r" % profile)
+
+
+def auto_profile(*disk_paths):
+    """Sizes the appliance on the data to inspect and the host resources.
+
+    One virtual CPU is added every AUTO_SMP_BYTES of data, up to half
+    the host CPUs, memory grows with the data up to a quarter of the host's.
+
+    """
+    size = sum(image_size(d) for d in disk_paths)
+    cpus = os.cpu_count() or 1
+    memory = host_memory() // 4 // 2**20
+
+    smp = max(1, min(MAX_SMP, cpus // 2, 1 + size // AUTO_SMP_BYTES))
+    memsize = BASE_MEMSIZE + size // AUTO_MEMSIZE_RATIO // 2**20
+    memsize = max(min(memsize, MAX_MEMSIZE, memory), MIN_MEMSIZE)
+
+    return PROFILES['readonly']._replace(smp=smp, memsize=memsize)
+
+
+def host_memory():
+    """Returns the physical memory of the host in bytes."""
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (ValueError, OSError):
+        return BASE_MEMSIZE * 4 * 2**20
+
+
+def disk_identity(disk_path, partition):
+    """Identifies the partition of the disk image by the image path,
+    size and modification time, returns an empty string if unavailable.
+
+    """
+    try:
+        status = os.stat(disk_path)
+    except OSError:
+        return ''
+
+    return '%s:%s:%d:%d' % (os.path.realpath(disk_path), partition,
+                            status.st_size, status.st_mtime_ns)
+
+
+def inspect_root(handler, root):
+    """Collects the Operating System information of the given root."""
+    osname = handler.inspect_get_type(root)
+    mountpoints = tuple(tuple(m) for m in handler.inspect_get_mountpoints(root))
+
+    if osname == 'windows':
+        drive = handler.inspect_get_drive_mappings(root)[0][0]
+    else:
+        drive = None
+
+    return Inspection(root, osname, drive, mountpoints)
+
+
+def disk_device(handler, device):
+    """Returns the disk block device containing the given device.
+
+    Logical Volumes are resolved through their Physical Volumes.
+
+    """
+    if handler.is_lv(device):
+        group = handler.lvm_canonical_lv_name(device).split('/')[2]
+        uuids = handler.vgpvuuids(group)
+        device = next(p for p in handler.pvs() if handler.pvuuid(p) in uuids)
+
+    try:
+        return handler.part_to_dev(device)
+    except RuntimeError:  # file system on the whole disk
+        return device
+
+
+def hash_filesystem(filesystem, hashtype='sha1', engine='appliance',
+                    dedupe=False, policy=None):
     """Utility function for running the files iterator at once.
 
+    See FileSystem.checksums for the engine, dedupe and policy keywords.
+
     Returns a dictionary.
 
         {'/path/on/filesystem': 'file_hash'}
 
     """
     try:
-        return dict(filesystem.checksums('/'))
+        return dict(filesystem.checksums('/', hashtype=hashtype, engine=engine,
+                                         dedupe=dedupe, policy=policy))
     except RuntimeError:
+        if policy == 'default':
+            policy = default_policy(filesystem.osname)
+
+        links = {}
         results = {}
+        statistics = filesystem.statistics
 
         logging.warning("Error hashing disk %s contents, iterating over files.",
                         filesystem.disk_path)
 
         for path in filesystem.nodes('/'):
             try:
-                regular = stat.S_ISREG(filesystem.stat(path)['mode'])
+                fstat = filesystem.stat(path)
             except RuntimeError:
                 continue  # unaccessible node
 
-            if regular:
-                try:
-                    results[path] = filesystem.checksum(path, hashtype=hashtype)
-                except RuntimeError:
-                    logging.debug("Unable to hash %s.", path)
+            if not stat.S_ISREG(fstat['mode']):
+                continue
+            if policy is not None and not policy.selected(path, fstat['size']):
+                continue
+
+            if fstat['nlink'] > 1 and fstat['ino'] in links:
+                statistics['skipped_bytes'] += fstat['size']
+                results[path] = links[fstat['ino']]
+                continue
+
+            try:
+                results[path] = filesystem.checksum(path, hashtype=hashtype)
+            except RuntimeError:
+                logging.debug("Unable to hash %s.", path)
+                continue
+
+            statistics['hashed_files'] += 1
+            statistics['hashed_bytes'] += fstat['size']
+
+            if fstat['nlink'] > 1:
+                links[fstat['ino']] = results[path]
 
         return results
 
 
+def sorted_checksums(filesystem, hashtype='sha1', engine='appliance',
+                     dedupe=False, policy=None, buffersize=1000000):
+    """Returns an iterator over the (path, hash) pairs of the filesystem
+    files sorted by path.
+
+    The hashes are streamed into an external sort keeping
+    at most buffersize pairs in memory, the rest is spilled on disk.
+
+    """
+    try:
+        return external_sort(filesystem.checksums(
+            '/', hashtype=hashtype, engine=engine, dedupe=dedupe,
+            policy=policy), buffersize=buffersize)
+    except RuntimeError:
+        return iter(sorted(hash_filesystem(
+            filesystem, hashtype=hashtype, engine=engine, dedupe=dedupe,
+            policy=policy).items()))
+
+
+def node_type(mode):
+    """Returns the type of a non regular node as reported by GuestFS.file."""
+    for check, name in NODE_TYPES:
+        if check(mode):
+            return name
+
+    return 'unknown'
+
+
+def hash_files(filesystem, paths, hashtype='sha1'):
+    """Hashes the given files.
+
+    Files which cannot be hashed are left out.
+
+    Returns a dictionary.
+
+        {'/path/on/filesystem': 'file_hash'}
+
+    """
+    results = {}
+
+    for path in paths:
+        try:
+            results[path] = filesystem.checksum(path, hashtype=hashtype)
+        except RuntimeError:
+            logging.debug("Unable to hash %s.", path)
+
+    return results
+
+
+def windows_tree(path):
+    """Returns True if the directory contains a Windows installation.
+
+    Folder names are matched case insensitively as on NTFS.
+
+    """
+    windows = host_folder(path, 'windows')
+
+    return windows is not None and host_folder(windows, 'system32') is not None
+
+
+def host_folder(path, name):
+    """Returns the path of the folder named as the lowercase name
+    within path regardless of its case, None if missing.
+
+    """
+    try:
+        entries = os.listdir(path)
+    except OSError:
+        return None
+
+    return next((os.path.join(path, n) for n in entries if n.lower() == name
+                 and os.path.isdir(os.path.join(path, n))), None)
+
+
+def lstatns(status):
+    """Converts an os.stat_result into a GuestFS.lstatns dictionary."""
+    fstat = {'st_' + k: int(getattr(status, 'st_' + k)) for k in STAT_FIELDS
+             if k not in ('atime', 'mtime', 'ctime')}
+
+    for name in ('atime', 'mtime', 'ctime'):
+        fstat.update(timespec('st_' + name, getattr(status, 'st_%s_ns' % name)))
+
+    return fstat
+
+
+def timespec(prefix, nanoseconds):
+    seconds, nanoseconds = divmod(nanoseconds, 10**9)
+
+    return {prefix + '_sec': seconds, prefix + '_nsec': nanoseconds}
+
+
+def tsk_type(mode):
+    for check, name in TSK_TYPES:
+        if check(mode):
+            return name
+
+    return '-'
+
+
+def inode_key(path, fstat):
+    """Hard links share the inode, other files are keyed by path."""
+    return fstat['st_ino'] if fstat['st_nlink'] > 1 else path
+
+
+def host_xattrs(path):
+    try:
+        return [(n, os.getxattr(path, n, follow_symlinks=False))
+                for n in os.listxattr(path, follow_symlinks=False)]
+    except OSError:
+        return []
+
+
+@contextmanager
+def host_errors():
+    """Raises host OSErrors as RuntimeErrors as GuestFS does."""
+    try:
+        yield
+    except OSError as error:
+        raise RuntimeError(error)
+
+
+def tar_escape(name):
+    """Escapes the wildcards in the name for tar exclusion patterns."""
+    return re.sub(r'([\\*?\[])', r'\\\1', name)
+
+
 def posix_path(*segments):
     return re.sub('^[a-zA-Z]:', '', os.path.join(*segments)).replace('\\', '/')
+
+
+Inspection = namedtuple('Inspection', ('root', 'osname', 'drive',
+                                       'mountpoints'))
+ApplianceProfile = namedtuple('ApplianceProfile', ('smp', 'memsize',
+                                                   'cachemode', 'copyonread'))
+
+
+PROFILES = {'default': ApplianceProfile(None, None, None, None),
+            'readonly': ApplianceProfile(None, None, 'unsafe', True)}
+MAX_SMP = 8
+MIN_MEMSIZE = 512
+BASE_MEMSIZE = 1024
+MAX_MEMSIZE = 8192
+AUTO_SMP_BYTES = 32 * 1024 * 1024 * 1024
+AUTO_MEMSIZE_RATIO = 32  # 32MB of memory per GB of data
+FIRST_DRIVE = '/dev/sda'
+NON_DATA_FILESYSTEMS = ('', 'swap', 'unknown', 'crypto_LUKS', 'LVM2_member')
+STAT_BATCH = 1000
+BULK_BATCH = 10000
+NODE_TYPES = ((stat.S_ISDIR, 'directory'),
+              (stat.S_ISLNK, 'symbolic link'),
+              (stat.S_ISCHR, 'character device'),
+              (stat.S_ISBLK, 'block device'),
+              (stat.S_ISFIFO, 'FIFO'),
+              (stat.S_ISSOCK, 'socket'))
+STAT_FIELDS = ('dev', 'ino', 'mode', 'nlink', 'uid', 'gid', 'rdev', 'size',
+               'blksize', 'blocks', 'atime', 'mtime', 'ctime')
+TSK_TYPES = ((stat.S_ISREG, 'r'),
+             (stat.S_ISDIR, 'd'),
+             (stat.S_ISLNK, 'l'),
+             (stat.S_ISCHR, 'c'),
+             (stat.S_ISBLK, 'b'),
+             (stat.S_ISFIFO, 'p'),
+             (stat.S_ISSOCK, 's'))
+DEFAULT_MAXSIZE = 1024 * 1024 * 1024
+SPECIAL_FILES = ('/pagefile.sys', '/hiberfil.sys', '/swapfile.sys',
+                 '/swapfile', '/swap.img')
+WINDOWS_EXCLUDE = ('*.vhd', '*.vhdx',
+                   '/$recycle.bin/*',
+                   '/system volume information/*',
+                   '/windows/softwaredistribution/download/*',
+                   '/users/*/appdata/local/temp/*',
+                   '/users/*/appdata/local/microsoft/windows/inetcache/*',
+                   '/users/*/appdata/local/microsoft/windows/'
+                   'temporary internet files/*',
+                   '/users/*/appdata/local/google/chrome/user data/*/cache/*',
+                   '/users/*/appdata/local/mozilla/firefox/profiles/*/cache2/*')
+LINUX_EXCLUDE = ('/proc/*', '/sys/*', '/dev/*', '/run/*', '/tmp/*',
+                 '/var/tmp/*', '/var/cache/*', '/home/*/.cache/*',
+                 '/root/.cache/*')
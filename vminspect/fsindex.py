@@ -0,0 +1,365 @@
+# Copyright (c) 2016-2017, Matteo Cafasso
+# All rights reserved.
+
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+
+# 3. Neither the name of the copyright holder nor the names of its contributors
+# may be used to endorse or promote products derived from this software without
+# specific prior written permission.
+
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+# THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS
+# BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY,
+# OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT
+# OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE
+# OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE,
+# EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+
+"""Compact columnar index of the File System content."""
+
+
+import json
+import mmap
+import struct
+import ntpath
+import posixpath
+from array import array
+from bisect import bisect_left
+from collections import namedtuple
+
+
+class FileSystemIndex:
+    """Columnar index of the nodes contained within a File System.
+
+    The index is built from a single filesystem_walk pass
+    and stores the nodes attributes in compact arrays.
+    Path components are interned in a sorted names table.
+
+    Nodes can be looked up by path and by inode.
+    Timestamps are stored as integer nanoseconds since the epoch
+    preserving the NTFS 100 nanoseconds precision.
+
+    The index can be saved to disk and memory mapped back
+    to avoid walking again the same disk image.
+
+    """
+    def __init__(self, columns, names, drive=None, mapping=None):
+        self._columns = columns
+        self._names = names
+        self._mapping = mapping
+
+        self.drive = drive
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def __len__(self):
+        return len(self._columns['inode'])
+
+    def __iter__(self):
+        return (self.entry(i) for i in range(len(self)))
+
+    @classmethod
+    def build(cls, filesystem):
+        """Builds the index walking the given mounted FileSystem."""
+        builder = IndexBuilder()
+
+        for entry in filesystem.filesystem_walk(filesystem.inspection.root):
+            builder.add(entry)
+
+        return cls(*builder.finalize(), drive=filesystem.inspection.drive)
+
+    @classmethod
+    def load(cls, path):
+        """Memory maps the index stored at the given path."""
+        with open(path, 'rb') as index_file:
+            mapping = mmap.mmap(index_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        view = memoryview(mapping)
+
+        if bytes(view[:len(MAGIC)]) != MAGIC:
+            raise ValueError("%s is not a File System index" % path)
+
+        length = HEADER.unpack_from(view, len(MAGIC))[0]
+        start = len(MAGIC) + HEADER.size
+        header = json.loads(bytes(view[start:start + length]).decode())
+        base = aligned(start + length)
+
+        columns = {name: view[base + offset:base + offset + size].cast(typecode)
+                   for name, typecode, offset, size in header['columns']}
+
+        return cls(columns, NamesTable(columns.pop('names_offsets'),
+                                       columns.pop('names_data')),
+                   drive=header['drive'], mapping=mapping)
+
+    def save(self, path):
+        """Stores the index at the given path."""
+        columns = dict(self._columns)
+        columns['names_offsets'] = self._names.offsets
+        columns['names_data'] = self._names.data
+
+        layout = []
+        offset = 0
+        for name in COLUMNS + ('names_offsets', 'names_data'):
+            column = columns[name]
+            size = len(column) * column.itemsize
+            layout.append((name, column.typecode, offset, size))
+            offset = aligned(offset + size)
+
+        header = json.dumps({'drive': self.drive, 'columns': layout}).encode()
+        base = aligned(len(MAGIC) + HEADER.size + len(header))
+
+        with open(path, 'wb') as index_file:
+            index_file.write(MAGIC + HEADER.pack(len(header)) + header)
+
+            for name, _, offset, _ in layout:
+                index_file.write(b'\0' * (base + offset - index_file.tell()))
+                index_file.write(memoryview(columns[name]).cast('B'))
+
+    def close(self):
+        """Releases the memory mapped file if any."""
+        if self._mapping is not None:
+            self._columns = {}
+            self._names = None
+            self._mapping.close()
+            self._mapping = None
+
+    def entry(self, index):
+        """Returns the IndexEntry at the given position."""
+        columns = self._columns
+
+        return IndexEntry(columns['inode'][index],
+                          self.path(index),
+                          columns['size'][index],
+                          chr(columns['type'][index]),
+                          bool(columns['flags'][index] & TSK_ALLOC),
+                          columns['atime'][index],
+                          columns['mtime'][index],
+                          columns['ctime'][index],
+                          columns['crtime'][index])
+
+    def path(self, index):
+        """Returns the File System path of the node at the given position."""
+        components = []
+        parents = self._columns['parent']
+
+        while index >= 0:
+            components.append(self._names[self._columns['name'][index]])
+            index = parents[index]
+
+        if self.drive is not None:
+            return '%s:\\%s' % (self.drive, ntpath.join(*reversed(components)))
+        else:
+            return posixpath.join('/', *reversed(components))
+
+    def lookup(self, path):
+        """Returns the IndexEntry of the node at the given path.
+
+        Allocated nodes are preferred over deleted ones.
+
+        """
+        parent = -1
+        components = [c for c in path.split(':', 1)[-1].replace('\\', '/')
+                      .split('/') if c]
+
+        for component in components:
+            parent = self._child(parent, self._names.index(component))
+
+        if parent < 0:
+            raise KeyError(path)
+
+        return self.entry(parent)
+
+    def lookup_inode(self, inode):
+        """Returns the list of IndexEntry with the given inode."""
+        inodes = SortedColumn(self._columns['inode'],
+                              self._columns['by_inode'])
+        position = inodes.bisect(inode)
+        entries = []
+
+        while position < len(inodes) and inodes[position] == inode:
+            entries.append(self.entry(self._columns['by_inode'][position]))
+            position += 1
+
+        return entries
+
+    def _child(self, parent, name):
+        keys = self._columns['keys']
+        key = child_key(parent, name)
+        position = bisect_left(keys, key)
+        found = None
+
+        while position < len(keys) and keys[position] == key:
+            found = self._columns['by_key'][position]
+
+            if self._columns['flags'][found] & TSK_ALLOC:
+                break
+
+            position += 1
+
+        if found is None:
+            raise KeyError(name)
+
+        return found
+
+
+class IndexBuilder:
+    """Collects filesystem_walk entries into the index columns."""
+    def __init__(self):
+        self._names = {}
+        self._directories = {}
+        self._pending = []
+        self._columns = {'inode': array('Q'), 'parent': array('q'),
+                         'name': array('I'), 'size': array('q'),
+                         'type': array('B'), 'flags': array('I'),
+                         'atime': array('q'), 'mtime': array('q'),
+                         'ctime': array('q'), 'crtime': array('q')}
+
+    def add(self, entry):
+        columns = self._columns
+        index = len(columns['inode'])
+        directory, name = posixpath.split(entry['tsk_name'].strip('/'))
+        parent = self._directories.get(directory, -1) if directory else -1
+
+        if directory and parent < 0:
+            self._pending.append((index, directory))
+        if entry['tsk_type'] == 'd':
+            self._directories.setdefault(entry['tsk_name'].strip('/'), index)
+
+        columns['inode'].append(entry['tsk_inode'])
+        columns['parent'].append(parent)
+        columns['name'].append(self._names.setdefault(name, len(self._names)))
+        columns['size'].append(entry['tsk_size'])
+        columns['type'].append(ord(entry['tsk_type'] or '-'))
+        columns['flags'].append(entry['tsk_flags'])
+        for attribute in ('atime', 'mtime', 'ctime', 'crtime'):
+            columns[attribute].append(
+                entry['tsk_%s_sec' % attribute] * 1000000000 +
+                entry['tsk_%s_nsec' % attribute])
+
+    def finalize(self):
+        """Resolves the parents, sorts the names table
+        and builds the lookup columns.
+
+        Returns the columns and the NamesTable.
+
+        """
+        columns = self._columns
+
+        for index, directory in self._pending:
+            columns['parent'][index] = self._directories.get(directory, -1)
+
+        names = sorted(self._names, key=lambda n: n.encode('utf8'))
+        remap = array('I', bytes(4 * len(names)))
+        for position, name in enumerate(names):
+            remap[self._names[name]] = position
+        columns['name'] = array('I', (remap[n] for n in columns['name']))
+
+        order = sorted(range(len(columns['inode'])), key=lambda i: child_key(
+            columns['parent'][i], columns['name'][i]))
+        columns['by_key'] = array('Q', order)
+        columns['keys'] = array('Q', (child_key(columns['parent'][i],
+                                                columns['name'][i])
+                                      for i in order))
+        columns['by_inode'] = array('Q', sorted(
+            range(len(columns['inode'])), key=columns['inode'].__getitem__))
+
+        return columns, NamesTable.build(names)
+
+
+class NamesTable:
+    """Sorted table of the interned path components."""
+    def __init__(self, offsets, data):
+        self.offsets = offsets
+        self.data = data
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        return bytes(self.data[self.offsets[index]:
+                               self.offsets[index + 1]]).decode('utf8')
+
+    @classmethod
+    def build(cls, names):
+        offsets = array('Q', [0])
+        data = bytearray()
+
+        for name in names:
+            data += name.encode('utf8')
+            offsets.append(len(data))
+
+        return cls(offsets, array('B', data))
+
+    def index(self, name):
+        """Returns the position of the given name, raises KeyError."""
+        encoded = name.encode('utf8')
+        low, high = 0, len(self)
+
+        while low < high:
+            middle = (low + high) // 2
+            current = bytes(self.data[self.offsets[middle]:
+                                      self.offsets[middle + 1]])
+
+            if current < encoded:
+                low = middle + 1
+            else:
+                high = middle
+
+        if low < len(self) and self[low] == name:
+            return low
+
+        raise KeyError(name)
+
+
+class SortedColumn:
+    """Presents a column through a sorting permutation."""
+    def __init__(self, column, order):
+        self._column = column
+        self._order = order
+
+    def __len__(self):
+        return len(self._order)
+
+    def __getitem__(self, index):
+        return self._column[self._order[index]]
+
+    def bisect(self, value):
+        return bisect_left(self, value)
+
+
+def child_key(parent, name):
+    return (parent + 1) << 32 | name
+
+
+def aligned(offset):
+    return offset + (-offset % 8)
+
+
+TSK_ALLOC = 0x01
+MAGIC = b'VMIIDX02'
+HEADER = struct.Struct('<Q')
+COLUMNS = ('inode', 'parent', 'name', 'size', 'type', 'flags',
+           'atime', 'mtime', 'ctime', 'crtime', 'by_key', 'keys', 'by_inode')
+
+
+IndexEntry = namedtuple('IndexEntry', ('inode', 'path', 'size', 'type',
+                                       'allocated', 'atime', 'mtime',
+                                       'ctime', 'crtime'))
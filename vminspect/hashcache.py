@@ -0,0 +1,151 @@
+# Copyright (c) 2016-2017, Matteo Cafasso
+# All rights reserved.
+
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+
+# 3. Neither the name of the copyright holder nor the names of its contributors
+# may be used to endorse or promote products derived from this software without
+# specific prior written permission.
+
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+# THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS
+# BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY,
+# OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT
+# OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE
+# OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE,
+# EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+"""Persistent cache of file content hashes."""
+
+
+import time
+import sqlite3
+import logging
+import threading
+
+
+class HashCache:
+    """SQLite backed cache of file hashes.
+
+    Entries are keyed by the file identity:
+
+        (filesystem UUID, inode, size, mtime, ctime, hashtype)
+
+    so that snapshots of the same Virtual Machine
+    do not need to hash again the files they share.
+    File systems without UUID are keyed by their disk image identity
+    instead, see FileSystem.cache_key.
+
+    Once more than maxsize entries are stored,
+    the least recently used ones are evicted.
+
+    """
+    def __init__(self, path, maxsize=10000000):
+        self.path = path
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._stores = 0
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute(SCHEMA)
+        self.logger = logging.getLogger(
+            "%s.%s" % (self.__module__, self.__class__.__name__))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    @property
+    def stats(self):
+        """Returns the cache statistics."""
+        with self._lock:
+            size = self._connection.execute(
+                "SELECT COUNT(*) FROM hashes").fetchone()[0]
+
+        return {'hits': self.hits, 'misses': self.misses, 'size': size}
+
+    def lookup(self, uuid, fstat, hashtype):
+        """Returns the cached hash of the file with the given status
+        or None if not present.
+
+        fstat is a lstatns dictionary.
+
+        """
+        key = (uuid, hashtype) + file_identity(fstat)
+
+        with self._lock:
+            row = self._connection.execute(LOOKUP, key).fetchone()
+
+            if row is not None:
+                self.hits += 1
+                self._connection.execute(TOUCH, (time.time(), ) + key)
+
+                return row[0]
+
+            self.misses += 1
+
+    def store(self, uuid, fstat, hashtype, digest):
+        """Stores the hash of the file with the given status."""
+        key = (uuid, hashtype) + file_identity(fstat)
+
+        with self._lock:
+            self._connection.execute(STORE, key + (digest, time.time()))
+            self._stores += 1
+
+            if self._stores % COMMIT_INTERVAL == 0:
+                self._evict()
+                self._connection.commit()
+
+    def close(self):
+        """Evicts the exceeding entries and stores the cache to disk."""
+        with self._lock:
+            self._evict()
+            self._connection.commit()
+            self._connection.close()
+
+        self.logger.debug("Hash cache hits %d, misses %d.",
+                          self.hits, self.misses)
+
+    def _evict(self):
+        self._connection.execute(EVICT, (self.maxsize, ))
+
+
+def file_identity(fstat):
+    return (fstat['st_ino'], fstat['st_size'],
+            fstat['st_mtime_sec'] * 10**9 + fstat['st_mtime_nsec'],
+            fstat['st_ctime_sec'] * 10**9 + fstat['st_ctime_nsec'])
+
+
+COMMIT_INTERVAL = 10000
+
+
+SCHEMA = """CREATE TABLE IF NOT EXISTS hashes (
+                uuid TEXT, hashtype TEXT, inode INTEGER, size INTEGER,
+                mtime INTEGER, ctime INTEGER, digest TEXT, used REAL,
+                PRIMARY KEY (uuid, hashtype, inode, size, mtime, ctime))"""
+LOOKUP = """SELECT digest FROM hashes
+            WHERE uuid = ? AND hashtype = ? AND inode = ?
+            AND size = ? AND mtime = ? AND ctime = ?"""
+TOUCH = """UPDATE hashes SET used = ?
+           WHERE uuid = ? AND hashtype = ? AND inode = ?
+           AND size = ? AND mtime = ? AND ctime = ?"""
+STORE = """INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?, ?, ?, ?)"""
+EVICT = """DELETE FROM hashes WHERE rowid IN (
+               SELECT rowid FROM hashes ORDER BY used DESC
+               LIMIT -1 OFFSET ?)"""
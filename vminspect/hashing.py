@@ -0,0 +1,206 @@
+# Copyright (c) 2016-2017, Matteo Cafasso
+# All rights reserved.
+
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+
+# 3. Neither the name of the copyright holder nor the names of its contributors
+# may be used to endorse or promote products derived from this software without
+# specific prior written permission.
+
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+# THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS
+# BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY,
+# OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT
+# OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE
+# OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE,
+# EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+
+"""Host side hashing of disk content streamed out of the appliance."""
+
+
+import os
+import hashlib
+import logging
+import posixpath
+import tarfile
+import multiprocessing
+from collections import OrderedDict, defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor
+
+from vminspect.pipes import appliance_stream
+
+
+def tar_hashes(handler, directory, hashtypes=('sha1', ), workers=None,
+               select=None):
+    """Hashes the files contained in directory on the host.
+
+    The directory tree is streamed out of the appliance once as tar archive,
+    its regular files are hashed by a pool of workers processes.
+    All the hash algorithms in hashtypes are computed in the same pass.
+
+    Hard links are hashed once. Links to files not selected carry
+    no content within the archive, they are hashed within the appliance
+    as well as the links too far from their target, see hash_stream.
+
+    select is an optional callable receiving the file relative path
+    and size, files for which it returns False are not hashed.
+
+    Yields the files relative path and a dictionary {hashtype: digest}.
+
+    """
+    with appliance_stream(handler.tar_out, directory) as stream:
+        unresolved = yield from hash_stream(stream, hashtypes, workers, select)
+
+    for name in unresolved:
+        path = posixpath.join(directory, name)
+
+        try:
+            yield name, {h: handler.checksum(h, path) for h in hashtypes}
+        except RuntimeError:
+            logging.debug("Unable to hash %s.", path)
+
+
+def hash_stream(stream, hashtypes, workers=None, select=None):
+    """Hashes the regular files contained in the tar stream.
+
+    Hashes are yielded as their batch is done, hard links together
+    with their target. The hashes of the last LINK_CACHE files are kept
+    for the links following them within the archive.
+
+    Returns the names of the links which target was not hashed
+    or is no longer cached.
+
+    """
+    links = []
+    recent = OrderedDict()
+    waiting = defaultdict(list)
+    pending = deque()
+    workers = workers or os.cpu_count()
+
+    # forkserver avoids forking the thread streaming the archive out
+    context = multiprocessing.get_context('forkserver')
+
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context) as pool:
+        for batch, large in tar_batches(stream, hashtypes, links, select):
+            yield from collect(large, recent, waiting)
+
+            pending.append(pool.submit(hash_batch, batch, hashtypes))
+
+            yield from link_hashes(links, recent, waiting)
+
+            while len(pending) > workers * 2:
+                yield from collect(pending.popleft().result(), recent, waiting)
+
+        while pending:
+            yield from collect(pending.popleft().result(), recent, waiting)
+
+    return [name for names in waiting.values() for name in names]
+
+
+def tar_batches(stream, hashtypes, links, select=None):
+    """Splits the tar stream into batches of small files.
+
+    Large files are hashed while reading them to bound memory usage,
+    their hashes are returned together with the batch.
+
+    """
+    size = 0
+    batch = []
+    large = []
+
+    with tarfile.open(fileobj=stream, mode='r|') as archive:
+        for member in archive:
+            name = member_name(member.name)
+
+            if select is not None and not select(name, member.size):
+                continue
+            if member.islnk():
+                links.append((name, member_name(member.linkname)))
+            elif member.isreg():
+                fileobj = archive.extractfile(member)
+
+                if member.size > LARGE_FILE:
+                    large.append((name, hash_fileobj(fileobj, hashtypes)))
+                else:
+                    batch.append((name, fileobj.read()))
+                    size += member.size
+
+                if size > BATCH_SIZE:
+                    yield batch, large
+
+                    size = 0
+                    batch = []
+                    large = []
+
+    yield batch, large
+
+
+def collect(hashes, recent, waiting):
+    """Yields the hashes followed by the hard links waiting for them
+    keeping the most recent ones for the links yet to come.
+
+    """
+    for name, digests in hashes:
+        yield name, digests
+
+        for link in waiting.pop(name, ()):
+            yield link, digests
+
+        recent[name] = digests
+        if len(recent) > LINK_CACHE:
+            recent.popitem(last=False)
+
+
+def link_hashes(links, recent, waiting):
+    """Yields the hashes of the links which target is cached,
+    the others wait for their target to be hashed.
+
+    """
+    for name, target in links:
+        if target in recent:
+            yield name, recent[target]
+        else:
+            waiting[target].append(name)
+
+    links.clear()
+
+
+def hash_batch(batch, hashtypes):
+    """Hashes a batch of (name, content) files."""
+    return [(name, {h: hashlib.new(h, data).hexdigest() for h in hashtypes})
+            for name, data in batch]
+
+
+def hash_fileobj(fileobj, hashtypes):
+    """Hashes the file reading it in chunks."""
+    hashes = [hashlib.new(h) for h in hashtypes]
+
+    for chunk in iter(lambda: fileobj.read(CHUNK_SIZE), b''):
+        for digest in hashes:
+            digest.update(chunk)
+
+    return {h: d.hexdigest() for h, d in zip(hashtypes, hashes)}
+
+
+def member_name(name):
+    return name[2:] if name.startswith('./') else name
+
+
+CHUNK_SIZE = 1024 * 1024
+BATCH_SIZE = 16 * 1024 * 1024
+LARGE_FILE = 64 * 1024 * 1024
+LINK_CACHE = 100000
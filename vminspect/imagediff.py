@@ -0,0 +1,127 @@
+# Copyright (c) 2016-2017, Matteo Cafasso
+# All rights reserved.
+
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+
+# 3. Neither the name of the copyright holder nor the names of its contributors
+# may be used to endorse or promote products derived from this software without
+# specific prior written permission.
+
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+# THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS
+# BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY,
+# OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT
+# OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE
+# OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE,
+# EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+
+"""Module for comparing disk images at block level through qemu-img."""
+
+
+import os
+import json
+import logging
+import subprocess
+
+
+def changed_ranges(disk0, disk1):
+    """Returns the byte ranges which differ between the two disk images.
+
+    The images are expected to be snapshots or overlays of a common base:
+    the ranges allocated above the common base image
+    in either of the two backing chains are deemed changed.
+
+    Returns a list of (start, end) tuples as seen by the guest,
+    an empty list if the images are identical
+    or None if the images do not share a base.
+
+    """
+    if os.path.realpath(disk0) == os.path.realpath(disk1):
+        return []
+
+    try:
+        chain0 = backing_chain(disk0)
+        chain1 = backing_chain(disk1)
+    except (OSError, subprocess.CalledProcessError) as error:
+        logging.debug("Unable to inspect images: %s", error)
+        return None
+
+    common = [i for i in chain0 if i in chain1]
+    if not common:
+        return None
+
+    ranges = (allocated_ranges(disk0, chain0.index(common[0])) +
+              allocated_ranges(disk1, chain1.index(common[0])))
+
+    return merge_ranges(ranges)
+
+
+def backing_chain(disk):
+    """Returns the list of images composing the backing chain of the disk,
+    the disk itself first.
+
+    """
+    output = qemu_img('info', '--backing-chain', '--output=json', disk)
+
+    return [os.path.realpath(i['filename']) for i in json.loads(output)]
+
+
+def image_size(disk):
+    """Returns the bytes allocated on the host by the disk
+    and its backing images.
+
+    """
+    try:
+        chain = backing_chain(disk)
+    except (OSError, subprocess.CalledProcessError):
+        chain = [disk]
+
+    return sum(os.path.getsize(i) for i in chain if os.path.isfile(i))
+
+
+def allocated_ranges(disk, depth):
+    """Returns the ranges of the disk allocated above the given depth
+    within its backing chain.
+
+    """
+    output = qemu_img('map', '--output=json', disk)
+
+    return [(e['start'], e['start'] + e['length'])
+            for e in json.loads(output) if e['depth'] < depth]
+
+
+def merge_ranges(ranges):
+    """Merges overlapping and adjacent ranges."""
+    merged = []
+
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(end, merged[-1][1]))
+        else:
+            merged.append((start, end))
+
+    return merged
+
+
+def overlapping(ranges, start, end):
+    """Returns True if any of the ranges overlaps with start-end."""
+    return any(s < end and start < e for s, e in ranges)
+
+
+def qemu_img(*arguments):
+    return subprocess.check_output(('qemu-img', ) + arguments,
+                                   stderr=subprocess.DEVNULL)
@@ -28,11 +28,11 @@
 # EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 import json
-import shutil
-import hashlib
 import logging
 import argparse
 from pathlib import Path
+from itertools import islice
+from datetime import datetime
 from collections import OrderedDict
 from tempfile import NamedTemporaryFile
 
@@ -40,12 +40,19 @@ from tempfile import NamedTemporaryFile
 from vtscan import VTScanner
 from vminspect.usnjrnl import usn_journal
 from vminspect.winevtx import WinEventLog
+from vminspect.hashcache import HashCache
+from vminspect.manifest import create_manifest
+from vminspect.extraction import ExtractionRequest, extract
 #from vminspect.vulnscan import VulnScanner
 from vulnscan import VulnScanner
-from vminspect.comparator import DiskComparator
+from vminspect.comparator import DiskComparator, MultiDiskComparator
+from vminspect.comparator import compare_partitions
 from vminspect.timeline import FSTimeline, NTFSTimeline
 from vminspect.winreg import RegistryHive, registry_root
-from vminspect.filesystem import FileSystem, hash_filesystem, posix_path
+from vminspect.filesystem import HashPolicy, open_filesystem
+from vminspect.filesystem import appliance_profile
+from vminspect.filesystem import disk_partitions, map_partitions
+from vminspect.filesystem import hash_filesystem, posix_path
 
 from load_cve import dl_remote
 import time
@@ -59,15 +66,31 @@ def main():
     logging.basicConfig(level=arguments.debug and logging.DEBUG or logging.INFO)
     logging.getLogger('requests').setLevel(logging.WARNING)
 
-    results = COMMANDS[arguments.name](arguments)
+    if arguments.hashcache is not None:
+        arguments.hashcache = HashCache(arguments.hashcache)
+
+    arguments.profile = resolve_profile(arguments)
+    logging.debug("Appliance profile: %s.", arguments.profile)
+
+    try:
+        results = COMMANDS[arguments.name](arguments)
+    finally:
+        if arguments.hashcache is not None:
+            logging.info("Hash cache statistics: %s.",
+                         arguments.hashcache.stats)
+            arguments.hashcache.close()
+
+    if results is None:  # results already streamed as JSON lines
+        return
 
     # file output specific code
     outputDict = {}
-    workloadStartIndex = arguments.disk.find('/workload')
-    INPUT_FILE_NAME = arguments.disk.replace("/","_")
+    disk = report_disk(arguments)
+    workloadStartIndex = disk.find('/workload')
+    INPUT_FILE_NAME = disk.replace("/","_")
     timestr = time.strftime("%Y%m%d-%H%M%S")
     if workloadStartIndex != -1 :
-        workloadString = arguments.disk[workloadStartIndex:]
+        workloadString = disk[workloadStartIndex:]
         splitlist = workloadString[1:].split('/')
         WORKLOAD_METADATA = splitlist[0]
         SNAPSHOT_METADATA = splitlist[1]
@@ -82,7 +105,7 @@ def main():
         outputDict["scanned_file"] = INPUT_FILE_NAME
 
         # find path of snapshot__ folder
-        snapshotPath = arguments.disk[:arguments.disk.find("/vm_id")]
+        snapshotPath = disk[:disk.find("/vm_id")]
     else:
         # else scan was called from outside trilio folder structure, so
         # scans folder is created in current directory
@@ -100,51 +123,148 @@ def main():
     if results is not None:
         # embed json results in dict
         resultDict  = {"results":results}
+        outputDict["appliance"] = arguments.profile._asdict()
         outputDict.update(resultDict)
         with open(outFilePath,'w+') as outfile:
             outfile.write(json.dumps(outputDict, indent=4))
         print(json.dumps(results, indent=2))
 
 
+def report_disk(arguments):
+    """Returns the disk the report file is named after,
+    the baseline one for the commands comparing many disks.
+
+    """
+    for attribute in ('disk', 'baseline', 'disk1'):
+        disk = getattr(arguments, attribute, None)
+
+        if disk is not None:
+            return disk
+
+    return arguments.name
+
+
 def list_files_command(arguments):
-    return list_files(arguments.disk, identify=arguments.identify, size=arguments.size)
+    def partition_files(partition):
+        return list_files(arguments.disk, identify=arguments.identify,
+                          size=arguments.size, hashcache=arguments.hashcache,
+                          engine=arguments.engine, dedupe=arguments.dedupe,
+                          policy=hash_policy(arguments),
+                          profile=arguments.profile, partition=partition)
+
+    if arguments.manifest is not None:
+        return list_manifest(arguments.disk, arguments.manifest,
+                             hashcache=arguments.hashcache,
+                             engine=arguments.engine, dedupe=arguments.dedupe,
+                             policy=hash_policy(arguments),
+                             profile=arguments.profile)
+    elif arguments.partitions:
+        return on_partitions(partition_files, arguments.disk, arguments)
+    else:
+        return partition_files(None)
+
 
+def list_manifest(disk, manifest, hashcache=None, engine='appliance',
+                  dedupe=False, policy=None, profile=None):
+    with open_filesystem(disk, hashcache=hashcache,
+                         profile=profile) as filesystem:
+        count = create_manifest(filesystem, manifest, engine=engine,
+                                dedupe=dedupe, policy=policy)
 
-def list_files(disk, identify=False, size=False):
+        return {'manifest': manifest, 'files': count,
+                'statistics': filesystem.statistics}
+
+
+def list_files(disk, identify=False, size=False, hashcache=None,
+               engine='appliance', dedupe=False, policy=None, profile=None,
+               partition=None):
     logger = logging.getLogger('filesystem')
 
-    with FileSystem(disk) as filesystem:
+    with open_filesystem(disk, hashcache=hashcache, profile=profile,
+                         partition=partition) as filesystem:
         logger.debug("Listing files.")
 
-        files = hash_filesystem(filesystem)
+        files = hash_filesystem(filesystem, engine=engine, dedupe=dedupe,
+                                policy=policy)
+        files = [{'path': p, 'sha1': h} for p, h in files.items()]
 
-        if identify:
-            logger.debug("Gatering file types.")
-            for file_meta in files:
-                file_meta['type'] = filesystem.file(file_meta['path'])
+        logger.debug("Hashing statistics: %s.", filesystem.statistics)
 
-        if size:
-            logger.debug("Gatering file sizes.")
-            for file_meta in files:
-                file_meta['size'] = filesystem.stat(file_meta['path'])['size']
+        if identify or size:
+            logger.debug("Gatering file metadata.")
+            metadata = filesystem.metadata((f['path'] for f in files),
+                                           identify=identify)
+
+            for file_meta, (_, meta) in zip(files, metadata):
+                if identify:
+                    file_meta['type'] = meta.get('type')
+                if size and meta['stat'] is not None:
+                    file_meta['size'] = meta['stat']['st_size']
 
     return files
 
 
 def compare_command(arguments):
+    if arguments.partitions:
+        if arguments.extract or arguments.registry:
+            logging.warning("Extraction and registry comparison "
+                            "are not supported across partitions.")
+
+        results = compare_partitions(
+            arguments.disk1, arguments.disk2, workers=arguments.workers,
+            hashcache=arguments.hashcache, profile=arguments.profile,
+            concurrent=arguments.concurrent, identify=arguments.identify,
+            size=arguments.size,
+            metadata=arguments.metadata or arguments.trust_metadata,
+            trust_metadata=arguments.trust_metadata, blocks=arguments.blocks,
+            engine=arguments.engine, dedupe=arguments.dedupe,
+            policy=hash_policy(arguments))
+
+        if arguments.jsonl:
+            for kind in ('created_files', 'deleted_files', 'modified_files'):
+                for entry in results.pop(kind):
+                    write_jsonl(dict(entry, kind=kind))
+            write_jsonl(results)
+
+            return None
+
+        return results
+
+    if arguments.jsonl:
+        return stream_compare_disks(arguments)
+
     return compare_disks(arguments.disk1, arguments.disk2,
                          identify=arguments.identify, size=arguments.size,
                          extract=arguments.extract, path=arguments.path,
                          registry=arguments.registry,
-                         concurrent=arguments.concurrent)
+                         concurrent=arguments.concurrent,
+                         shared=arguments.shared,
+                         metadata=arguments.metadata,
+                         trust_metadata=arguments.trust_metadata,
+                         blocks=arguments.blocks,
+                         engine=arguments.engine,
+                         dedupe=arguments.dedupe,
+                         policy=hash_policy(arguments),
+                         hashcache=arguments.hashcache,
+                         profile=arguments.profile)
 
 
 def compare_disks(disk1, disk2, identify=False, size=False, registry=False,
-                  extract=False, path='.', concurrent=False):
-    with DiskComparator(disk1, disk2) as comparator:
+                  extract=False, path='.', concurrent=False, shared=False,
+                  metadata=False, trust_metadata=False, blocks=False,
+                  engine='appliance', dedupe=False, policy=None,
+                  hashcache=None, profile=None):
+    with DiskComparator(disk1, disk2, shared=shared, hashcache=hashcache,
+                        profile=profile) as comparator:
         results = comparator.compare(concurrent=concurrent,
                                      identify=identify,
-                                     size=size)
+                                     size=size,
+                                     metadata=metadata or trust_metadata,
+                                     trust_metadata=trust_metadata,
+                                     blocks=blocks,
+                                     engine=engine,
+                                     dedupe=dedupe,
+                                     policy=policy)
         if extract:
             extract = results['created_files'] + results['modified_files']
             files = comparator.extract(1, extract, path=path)
@@ -159,6 +279,63 @@ def compare_disks(disk1, disk2, identify=False, size=False, registry=False,
     return results
 
 
+def stream_compare_disks(arguments):
+    """Writes the differences as JSON lines as soon as they are found,
+    the extraction and registry reports are written last.
+
+    See DiskComparator.compare_iter for when differences are found,
+    the files to extract are collected until the end of the comparison.
+
+    """
+    extracted = []
+
+    with DiskComparator(arguments.disk1, arguments.disk2,
+                        shared=arguments.shared, hashcache=arguments.hashcache,
+                        profile=arguments.profile) as comparator:
+        for kind, entry in comparator.compare_iter(
+                concurrent=arguments.concurrent, identify=arguments.identify,
+                size=arguments.size,
+                metadata=arguments.metadata or arguments.trust_metadata,
+                trust_metadata=arguments.trust_metadata,
+                blocks=arguments.blocks, engine=arguments.engine,
+                dedupe=arguments.dedupe, policy=hash_policy(arguments)):
+            write_jsonl(dict(entry, kind=kind))
+
+            if arguments.extract and kind != 'deleted_files':
+                extracted.append(entry)
+
+        if arguments.extract:
+            write_jsonl(comparator.extract(1, extracted, path=arguments.path))
+
+        if arguments.registry:
+            write_jsonl({'registry': comparator.compare_registry(
+                concurrent=arguments.concurrent)})
+
+
+def write_jsonl(record):
+    print(json.dumps(record), flush=True)
+
+
+def multicompare_command(arguments):
+    logger = logging.getLogger('multicompare')
+    reports = []
+
+    with MultiDiskComparator(arguments.baseline, arguments.targets,
+                             workers=arguments.workers or 2,
+                             hashcache=arguments.hashcache,
+                             profile=arguments.profile) as comparator:
+        for target, report in comparator.compare(
+                identify=arguments.identify, size=arguments.size,
+                registry=arguments.registry, engine=arguments.engine,
+                dedupe=arguments.dedupe, policy=hash_policy(arguments)):
+            logger.info("Compared %s against %s.", target, arguments.baseline)
+
+            report['disk'] = target
+            reports.append(report)
+
+    return reports
+
+
 def registry_command(arguments):
     return parse_registry(
         arguments.hive, disk=arguments.disk, sort=arguments.sort)
@@ -166,7 +343,7 @@ def registry_command(arguments):
 
 def parse_registry(hive, disk=None, sort=False):
     if disk is not None:
-        with FileSystem(disk) as filesystem:
+        with open_filesystem(disk) as filesystem:
             registry = extract_registry(filesystem, hive)
     else:
         registry = RegistryHive(hive)
@@ -196,7 +373,8 @@ def vtscan_command(arguments):
         filetypes = arguments.types and arguments.types.split(',') or None
 
         #vtscanner.scan(filetypes=filetypes)
-        return [r._asdict() for r in vtscanner.scan(filetypes=filetypes)]
+        return [r._asdict() for r in vtscanner.scan(
+            filetypes=filetypes, policy=hash_policy(arguments))]
         # return []
 
 
@@ -217,7 +395,7 @@ def usnjrnl_command(arguments):
 
 def parse_usnjrnl(usnjrnl, disk=None):
     if disk is not None:
-        with FileSystem(disk) as filesystem:
+        with open_filesystem(disk) as filesystem:
             return extract_usnjrnl(filesystem, usnjrnl)
     else:
         return [e._asdict() for e in usn_journal(usnjrnl)]
@@ -225,18 +403,47 @@ def parse_usnjrnl(usnjrnl, disk=None):
 
 def extract_usnjrnl(filesystem, path):
     with NamedTemporaryFile(buffering=0) as tempfile:
-        root = filesystem.inspect_get_roots()[0]
+        root = filesystem.inspection.root
         inode = filesystem.stat(path)['ino']
-        filesystem.download_inode(root, inode, tempfile.name)
+        filesystem.download_inode(root, inode, tempfile.name, sparse=True)
 
         return [e._asdict() for e in usn_journal(tempfile.name)]
 
 
 def timeline_command(arguments):
+    def partition_timeline(partition):
+        return filesystem_timeline(arguments, partition=partition)
+
+    if arguments.partitions:
+        events = on_partitions(partition_timeline, arguments.disk, arguments)
+        events = sorted(events, key=lambda e: e['timestamp'])
+    elif arguments.jsonl:
+        return stream_timeline(arguments)
+    else:
+        events = partition_timeline(None)
+
+    if arguments.jsonl:
+        for event in events:
+            write_jsonl(event)
+
+        return None
+
+    return events
+
+
+def filesystem_timeline(arguments, partition=None):
     logger = logging.getLogger('timeline')
 
-    with FSTimeline(arguments.disk) as timeline:
-        events = [e._asdict() for e in timeline.timeline()]
+    index = arguments.index
+    if index is not None and partition is not None:
+        index = '%s.%s' % (index, partition.strip('/').replace('/', '_'))
+
+    with FSTimeline(arguments.disk, hashcache=arguments.hashcache,
+                    profile=arguments.profile, partition=partition,
+                    index=index) as timeline:
+        events = [e._asdict() for e in
+                  timeline.timeline(buffersize=arguments.buffer_size,
+                                    **timeline_filters(arguments))]
 
         if arguments.identify:
             logger.debug("Gatering file types.")
@@ -249,11 +456,36 @@ def timeline_command(arguments):
     return events
 
 
+def stream_timeline(arguments):
+    """Writes the timeline events as JSON lines as soon as sorted,
+    file types and hashes are gathered for batches of events.
+
+    """
+    with FSTimeline(arguments.disk, hashcache=arguments.hashcache,
+                    profile=arguments.profile,
+                    index=arguments.index) as timeline:
+        events = (e._asdict() for e in
+                  timeline.timeline(buffersize=arguments.buffer_size,
+                                    **timeline_filters(arguments)))
+
+        for batch in iter(lambda: list(islice(events, EVENTS_BATCH)), []):
+            if arguments.identify:
+                identify_files(timeline, batch)
+            if arguments.hash:
+                calculate_hashes(timeline, batch)
+
+            for event in batch:
+                write_jsonl(event)
+
+
 def usnjrnl_timeline_command(arguments):
     logger = logging.getLogger('usnjrnl_timeline')
 
-    with NTFSTimeline(arguments.disk) as timeline:
-        events = [e._asdict() for e in timeline.usnjrnl_timeline()]
+    with NTFSTimeline(arguments.disk, hashcache=arguments.hashcache,
+                      profile=arguments.profile,
+                      index=arguments.index) as timeline:
+        events = [e._asdict() for e in timeline.usnjrnl_timeline(
+            **timeline_filters(arguments))]
 
         if arguments.identify:
             logger.debug("Gatering file types.")
@@ -274,73 +506,69 @@ def usnjrnl_timeline_command(arguments):
     return events
 
 
-def identify_files(timeline, events):
-    for event in (e for e in events if e['allocated']):
-        try:
-            event['type'] = timeline.file(event['path'])
-        except RuntimeError:
-            pass
+def on_partitions(function, disk, arguments):
+    """Runs function concurrently on all the partitions of the disk
+    merging the resulting lists tagging each item with its partition.
+
+    """
+    partitions = disk_partitions(disk, profile=arguments.profile)
+    results = map_partitions(function, partitions, arguments.workers)
+
+    return [dict(item, partition=partition)
+            for partition, items in results.items() for item in items]
 
-    return events
+
+def identify_files(timeline, events):
+    return enrich_events(timeline, events, 'type', identify=True)
 
 
 def calculate_hashes(timeline, events):
+    return enrich_events(timeline, events, 'hash', hashtype='sha1')
+
+
+def enrich_events(timeline, events, key, **kwargs):
+    """Retrieves the metadata once per path and adds it to the events."""
+    paths = OrderedDict.fromkeys(e['path'] for e in events if e['allocated'])
+    metadata = dict(timeline.metadata(paths, **kwargs))
+
     for event in (e for e in events if e['allocated']):
-        try:
-            event['hash'] = timeline.checksum(event['path'])
-        except RuntimeError:
-            pass
+        if key in metadata[event['path']]:
+            event[key] = metadata[event['path']][key]
 
     return events
 
 
 def extract_created_files(timeline, path, events):
-    path = Path(path)
-
-    if not path.exists():
-        path.mkdir(parents=True)
+    events = [e for e in events
+              if 'FILE_CREATE' in e['changes'] and e['allocated']]
+    requests = [ExtractionRequest(e['path'], e.get('hash'),
+                                  Path(posix_path(e['path'])).name)
+                for e in events]
 
-    for event in (e for e in events
-                  if 'FILE_CREATE' in e['changes'] and e['allocated']):
-        try:
-            if 'hash' in event:
-                sha_hash = event['hash']
-            else:
-                sha_hash = timeline.checksum(event['path'])
-            source = event['path']
-            name = Path(posix_path(event['path'])).name
-            destination = Path(path, '_'.join((sha_hash, name)))
-
-            if not destination.exists():
-                timeline.download(source, str(destination))
-        except RuntimeError:
-            pass
+    report_extraction(extract(timeline, requests, path))
 
 
 def extract_deleted_files(timeline, path, events):
-    path = Path(path)
-    root = timeline.inspect_get_roots()[0]
+    events = [e for e in events if 'FILE_DELETE' in e['changes']]
+    requests = [ExtractionRequest(e['file_reference_number'], None,
+                                  Path(posix_path(e['path'])).name)
+                for e in events]
+    results = extract(timeline, requests, path)
 
-    if not path.exists():
-        path.mkdir(parents=True)
+    for event, result in zip(events, results):
+        event['recovered'] = result.error is None
 
-    for event in (e for e in events if 'FILE_DELETE' in e['changes']):
-        inode = event['file_reference_number']
+        if result.error is None:
+            event['hash'] = result.sha1
 
-        try:
-            with NamedTemporaryFile(buffering=0) as tempfile:
-                timeline.download_inode(root, inode, tempfile.name)
+    report_extraction(results)
 
-                name = Path(posix_path(event['path'])).name
-                sha_hash = hashlib.sha1(tempfile.read()).hexdigest()
-                destination = Path(path, '_'.join((sha_hash, name)))
 
-                shutil.copy(tempfile.name, str(destination))
+def report_extraction(results):
+    logger = logging.getLogger('extraction')
 
-                event['hash'] = sha_hash
-                event['recovered'] = True
-        except RuntimeError:
-            event['recovered'] = False
+    for result in (r for r in results if r.error is not None):
+        logger.debug("Unable to extract %s: %s", result.source, result.error)
 
 
 def eventlog_command(arguments):
@@ -348,10 +576,94 @@ def eventlog_command(arguments):
         print('\n'.join(eventlog.eventlog(arguments.path)))
 
 
+def hash_policy(arguments):
+    if arguments.default_policy:
+        return 'default'
+    elif arguments.include or arguments.exclude or arguments.maxsize:
+        return HashPolicy(include=arguments.include or (),
+                          exclude=arguments.exclude or (),
+                          maxsize=arguments.maxsize)
+
+
+def timeline_filters(arguments):
+    return {'since': arguments.since, 'until': arguments.until,
+            'prefix': arguments.prefix, 'reasons': arguments.reason}
+
+
+def parse_date(string):
+    """Parses the UTC date or datetime given on the command line."""
+    for dateformat in DATE_FORMATS:
+        try:
+            return datetime.strptime(string, dateformat)
+        except ValueError:
+            continue
+
+    raise argparse.ArgumentTypeError("invalid date: %r" % string)
+
+
+def resolve_profile(arguments):
+    """Resolves the appliance profile sizing it on the command disks
+    and applies the explicit overrides.
+
+    """
+    disks = [getattr(arguments, a)
+             for a in ('disk', 'disk1', 'disk2', 'baseline')
+             if getattr(arguments, a, None) is not None]
+    profile = appliance_profile(arguments.profile, *disks)
+    overrides = {k: getattr(arguments, k) for k in ('smp', 'memsize',
+                                                    'cachemode')
+                 if getattr(arguments, k) is not None}
+
+    return profile._replace(**overrides)
+
+
+def add_policy_arguments(parser):
+    parser.add_argument('--include', type=str, action='append',
+                        help='hash only files matching the glob pattern')
+    parser.add_argument('--exclude', type=str, action='append',
+                        help='do not hash files matching the glob pattern')
+    parser.add_argument('--maxsize', type=int, default=None,
+                        help='do not hash files bigger than maxsize bytes')
+    parser.add_argument('--default-policy', action='store_true',
+                        default=False,
+                        help='skip Operating System files not worth hashing')
+
+
+def add_index_argument(parser):
+    parser.add_argument('--index', type=str, default=None,
+                        help='read the disk content from the index file, '
+                        'built and stored there if missing')
+
+
+def add_filter_arguments(parser):
+    parser.add_argument('--since', type=parse_date, default=None,
+                        help='events since the UTC date (YYYY-MM-DD[ HH:MM:SS])')
+    parser.add_argument('--until', type=parse_date, default=None,
+                        help='events until the UTC date (YYYY-MM-DD[ HH:MM:SS])')
+    parser.add_argument('--prefix', type=str, default=None,
+                        help='events of the files under the given path')
+    parser.add_argument('--reason', type=str, action='append',
+                        help='events with the given reason or USN change')
+
+
 def parse_arguments():
     parser = argparse.ArgumentParser(description='Inspects VM disk images.')
     parser.add_argument('-d', '--debug', action='store_true', default=False,
                         help='log in debug mode')
+    parser.add_argument('--hashcache', type=str, default=None,
+                        help='path to persistent file hashes cache')
+    parser.add_argument('--profile', type=str, default='default',
+                        choices=('default', 'readonly', 'auto'),
+                        help='appliance resources profile')
+    parser.add_argument('--smp', type=int, default=None,
+                        help='appliance virtual CPUs')
+    parser.add_argument('--memsize', type=int, default=None,
+                        help='appliance memory in MB')
+    parser.add_argument('--cachemode', type=str, default=None,
+                        choices=('writeback', 'unsafe'),
+                        help='appliance drives cache mode')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='partitions processed concurrently')
 
     subparsers = parser.add_subparsers(dest='name', title='subcommands',
                                        description='valid subcommands')
@@ -363,13 +675,26 @@ def parse_arguments():
                              default=False, help='report file types')
     list_parser.add_argument('-s', '--size', action='store_true',
                              default=False, help='report file sizes')
+    list_parser.add_argument('-E', '--engine', type=str, default='appliance',
+                             choices=('appliance', 'host'),
+                             help='where to hash the files')
+    list_parser.add_argument('-D', '--dedupe', action='store_true',
+                             default=False,
+                             help='hash hard linked files once')
+    list_parser.add_argument('-M', '--manifest', type=str, default=None,
+                             help='store the sorted files hashes manifest '
+                             'at the given path instead of listing them')
+    list_parser.add_argument('--partitions', action='store_true',
+                             default=False,
+                             help='process all OS roots and data partitions')
+    add_policy_arguments(list_parser)
 
     compare_parser = subparsers.add_parser('compare',
                                            help='Compares two disks.')
     compare_parser.add_argument('disk1', type=str,
-                                help='path to first disk image')
+                                help='path to first disk image or manifest')
     compare_parser.add_argument('disk2', type=str,
-                                help='path to second disk image')
+                                help='path to second disk image or manifest')
     compare_parser.add_argument('-c', '--concurrent', action='store_true',
                                 default=False, help='use concurrency')
     compare_parser.add_argument('-e', '--extract', action='store_true',
@@ -382,6 +707,56 @@ def parse_arguments():
                                 default=False, help='report file sizes')
     compare_parser.add_argument('-r', '--registry', action='store_true',
                                 default=False, help='compare registry')
+    compare_parser.add_argument('--shared', action='store_true',
+                                default=False,
+                                help='mount both disks in a single appliance')
+    compare_parser.add_argument('-m', '--metadata', action='store_true',
+                                default=False,
+                                help='hash only files which metadata differ')
+    compare_parser.add_argument('--trust-metadata', action='store_true',
+                                default=False,
+                                help='compare files by metadata only')
+    compare_parser.add_argument('-b', '--blocks', action='store_true',
+                                default=False,
+                                help='skip unchanged snapshots of a common base '
+                                     'via qemu-img')
+    compare_parser.add_argument('-E', '--engine', type=str,
+                                default='appliance',
+                                choices=('appliance', 'host'),
+                                help='where to hash the files')
+    compare_parser.add_argument('-D', '--dedupe', action='store_true',
+                                default=False,
+                                help='hash hard linked files once')
+    compare_parser.add_argument('--partitions', action='store_true',
+                                default=False,
+                                help='compare all OS roots and data partitions')
+    compare_parser.add_argument('--jsonl', action='store_true', default=False,
+                                help='print differences as JSON lines '
+                                'once both disks are hashed, '
+                                'files are extracted at the end')
+    add_policy_arguments(compare_parser)
+
+    multicompare_parser = subparsers.add_parser(
+        'multicompare', help='Compares many disks against a baseline one.')
+    multicompare_parser.add_argument('baseline', type=str,
+                                     help='path to baseline disk or manifest')
+    multicompare_parser.add_argument('targets', type=str, nargs='+',
+                                     help='path to disks to compare')
+    multicompare_parser.add_argument('-i', '--identify', action='store_true',
+                                     default=False, help='report file types')
+    multicompare_parser.add_argument('-s', '--size', action='store_true',
+                                     default=False, help='report file sizes')
+    multicompare_parser.add_argument('-r', '--registry', action='store_true',
+                                     default=False,
+                                     help='compare the registry')
+    multicompare_parser.add_argument('-E', '--engine', type=str,
+                                     default='appliance',
+                                     choices=('appliance', 'host'),
+                                     help='where to hash the files')
+    multicompare_parser.add_argument('-D', '--dedupe', action='store_true',
+                                     default=False,
+                                     help='hash hard linked files once')
+    add_policy_arguments(multicompare_parser)
 
     registry_parser = subparsers.add_parser(
         'registry', help='Lists the content of a registry file.')
@@ -401,6 +776,7 @@ def parse_arguments():
     vtscan_parser.add_argument(
         '-t', '--types', type=str, default='',
         help='comma separated list of file types (REGEX) to be scanned')
+    add_policy_arguments(vtscan_parser)
 
     # vulnscan arguments:
     # changes made here to download CVE db feed from NVD
@@ -434,6 +810,16 @@ def parse_arguments():
                                  action='store_true', help='report file types')
     timeline_parser.add_argument('-s', '--hash', action='store_true',
                                  default=False, help='report file hash (SHA1)')
+    timeline_parser.add_argument('--partitions', action='store_true',
+                                 default=False,
+                                 help='process all OS roots and data partitions')
+    timeline_parser.add_argument('--jsonl', action='store_true', default=False,
+                                 help='print events as JSON lines')
+    timeline_parser.add_argument('--buffer-size', type=int, default=1000000,
+                                 help='events sorted in memory, '
+                                 'the others are sorted on disk')
+    add_filter_arguments(timeline_parser)
+    add_index_argument(timeline_parser)
 
     usnjrnl_timeline_parser = subparsers.add_parser(
         'usnjrnl_timeline', help="""Parses the NTFS Update Sequence Number
@@ -452,6 +838,8 @@ def parse_arguments():
     usnjrnl_timeline_parser.add_argument('-r', '--recover', type=str,
                                          default='',
                                          help='Try recovering deleted files')
+    add_filter_arguments(usnjrnl_timeline_parser)
+    add_index_argument(usnjrnl_timeline_parser)
 
     eventlog_parser = subparsers.add_parser(
         'eventlog', help="""Parses the given Windows Event Log.""")
@@ -469,6 +857,7 @@ def parse_arguments():
 # Parse Windows Event Log files.
 COMMANDS = {'list': list_files_command,
             'compare': compare_command,
+            'multicompare': multicompare_command,
             'registry': registry_command,
             'vtscan': vtscan_command,
             'vulnscan': vulnscan_command,
@@ -477,6 +866,10 @@ COMMANDS = {'list': list_files_command,
             'usnjrnl_timeline': usnjrnl_timeline_command,
             'eventlog': eventlog_command}
 
+EVENTS_BATCH = 10000
+DATE_FORMATS = ('%Y-%m-%d', '%Y-%m-%d %H:%M:%S', '%Y-%m-%dT%H:%M:%S',
+                '%Y-%m-%d %H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S.%f')
+
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,255 @@
+# Copyright (c) 2016-2017, Matteo Cafasso
+# All rights reserved.
+
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+
+# 3. Neither the name of the copyright holder nor the names of its contributors
+# may be used to endorse or promote products derived from this software without
+# specific prior written permission.
+
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+# THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS
+# BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY,
+# OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT
+# OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE
+# OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE,
+# EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+
+"""Compact sorted manifests of the files hashes of a File System."""
+
+
+import mmap
+import shutil
+import struct
+import hashlib
+from itertools import islice
+from tempfile import TemporaryFile
+from collections import namedtuple
+
+from vminspect.filesystem import sorted_checksums
+
+
+class Manifest:
+    """Memory mapped manifest of the files of a File System.
+
+    A manifest lists path, size, modification time and hash
+    of the regular files sorted by path.
+    Records are stored in fixed size slots followed by the UTF-8 paths,
+    manifests are compared reading the raw paths and digests
+    without decoding the unchanged files.
+
+    Manifests are created by create_manifest.
+
+    """
+    def __init__(self, path):
+        with open(path, 'rb') as manifest_file:
+            self._mapping = mmap.mmap(manifest_file.fileno(), 0,
+                                      access=mmap.ACCESS_READ)
+
+        if self._mapping[:len(MAGIC)] != MAGIC:
+            self._mapping.close()
+            raise ValueError("%s is not a manifest" % path)
+
+        count, names, hashtype, osname = HEADER.unpack_from(self._mapping,
+                                                            len(MAGIC))
+
+        self.disk_path = path
+        self.hashtype = hashtype.rstrip(b'\0').decode()
+        self.osname = osname.rstrip(b'\0').decode()
+        self._count = count
+        self._names = names
+        self._digest_size = hashlib.new(self.hashtype).digest_size
+        self._record = struct.Struct(RECORD + '%ds' % self._digest_size)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def __len__(self):
+        return self._count
+
+    def __iter__(self):
+        return (self.entry(i) for i in range(self._count))
+
+    def close(self):
+        self._mapping.close()
+
+    def entry(self, index):
+        """Returns the ManifestEntry at the given position."""
+        path, size, mtime, digest = self._raw(index)
+
+        return ManifestEntry(path.decode('utf8'), size, mtime, digest.hex())
+
+    def lookup(self, path):
+        """Returns the ManifestEntry of the file at the given path."""
+        key = path.encode('utf8')
+        low, high = 0, self._count
+
+        while low < high:
+            middle = (low + high) // 2
+
+            if self._path(middle) < key:
+                low = middle + 1
+            else:
+                high = middle
+
+        if low < self._count and self._path(low) == key:
+            return self.entry(low)
+
+        raise KeyError(path)
+
+    def checksums(self, policy=None):
+        """Iterates over the files hashes sorted by path.
+
+        Files excluded by the HashPolicy are left out.
+
+        """
+        for entry in self:
+            if policy is None or policy.selected(entry.path, entry.size):
+                yield entry.path, entry.hash
+
+    def raw_checksums(self):
+        """Iterates over the undecoded (path, digest) pairs."""
+        return ((p, d) for p, _, _, d in map(self._raw, range(self._count)))
+
+    def metadata(self, paths, identify=False, hashtype=None, xattrs=False):
+        """FileSystem.metadata counterpart: only size and
+        modification time are known, file types are not.
+
+        """
+        for path in paths:
+            try:
+                entry = self.lookup(path)
+            except KeyError:
+                yield path, {'stat': None}
+                continue
+
+            meta = {'stat': {'st_size': entry.size,
+                             'st_mtime_sec': entry.mtime // 10**9,
+                             'st_mtime_nsec': entry.mtime % 10**9}}
+            if identify:
+                meta['type'] = None
+            if hashtype == self.hashtype:
+                meta['hash'] = entry.hash
+
+            yield path, meta
+
+    def _raw(self, index):
+        offset, length, size, mtime, digest = self._record.unpack_from(
+            self._mapping, HEADER_SIZE + index * self._record.size)
+        offset += self._names
+
+        return self._mapping[offset:offset + length], size, mtime, digest
+
+    def _path(self, index):
+        offset, length = PATH.unpack_from(
+            self._mapping, HEADER_SIZE + index * self._record.size)
+        offset += self._names
+
+        return self._mapping[offset:offset + length]
+
+
+def create_manifest(filesystem, path, hashtype='sha1', engine='appliance',
+                    dedupe=False, policy=None):
+    """Hashes the files of the mounted FileSystem storing the manifest
+    at the given path.
+
+    The hashes are sorted through an external sort and their files
+    status is retrieved in bulk, memory usage does not depend
+    on the amount of files.
+
+    See FileSystem.checksums for the engine, dedupe and policy keywords.
+
+    Returns the amount of files in the manifest.
+
+    """
+    hashes = sorted_checksums(filesystem, hashtype=hashtype, engine=engine,
+                              dedupe=dedupe, policy=policy)
+
+    def entries():
+        for chunk in iter(lambda: list(islice(hashes, STATUS_BATCH)), []):
+            metadata = filesystem.metadata(p for p, _ in chunk)
+
+            for (node, digest), (_, meta) in zip(chunk, metadata):
+                fstat = meta['stat']
+
+                if fstat is None:
+                    yield node, 0, 0, digest
+                else:
+                    yield node, fstat['st_size'], \
+                        fstat['st_mtime_sec'] * 10**9 + fstat['st_mtime_nsec'], \
+                        digest
+
+    return write_manifest(path, entries(), hashtype, filesystem.osname)
+
+
+def write_manifest(path, entries, hashtype, osname):
+    """Writes the (path, size, mtime, hash) entries sorted by path
+    into the manifest at the given path.
+
+    Returns the amount of entries written.
+
+    """
+    count = 0
+    offset = 0
+    record = struct.Struct(RECORD + '%ds' % hashlib.new(hashtype).digest_size)
+
+    with open(path, 'wb') as manifest_file, TemporaryFile() as names:
+        manifest_file.write(b'\0' * HEADER_SIZE)
+
+        for node, size, mtime, digest in entries:
+            name = node.encode('utf8')
+
+            manifest_file.write(record.pack(offset, len(name), size, mtime,
+                                            bytes.fromhex(digest)))
+            names.write(name)
+
+            offset += len(name)
+            count += 1
+
+        start = manifest_file.tell()
+        names.seek(0)
+        shutil.copyfileobj(names, manifest_file)
+
+        manifest_file.seek(0)
+        manifest_file.write(MAGIC + HEADER.pack(count, start,
+                                                hashtype.encode(),
+                                                osname.encode()))
+
+    return count
+
+
+def is_manifest(path):
+    """Returns True if the file at the given path is a manifest."""
+    try:
+        with open(path, 'rb') as manifest_file:
+            return manifest_file.read(len(MAGIC)) == MAGIC
+    except OSError:
+        return False
+
+
+MAGIC = b'VMIMAN01'
+HEADER = struct.Struct('<QQ16s16s')
+HEADER_SIZE = len(MAGIC) + HEADER.size
+PATH = struct.Struct('<QI')
+RECORD = '<QIQq'
+STATUS_BATCH = 10000
+
+
+ManifestEntry = namedtuple('ManifestEntry', ('path', 'size', 'mtime', 'hash'))
@@ -0,0 +1,135 @@
+# Copyright (c) 2016-2017, Matteo Cafasso
+# All rights reserved.
+
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+
+# 3. Neither the name of the copyright holder nor the names of its contributors
+# may be used to endorse or promote products derived from this software without
+# specific prior written permission.
+
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+# THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS
+# BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY,
+# OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT
+# OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE
+# OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE,
+# EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+
+"""Streaming of appliance output files to the host through named pipes."""
+
+
+import os
+import errno
+import logging
+import tempfile
+from contextlib import contextmanager
+
+from pebble import concurrent
+
+
+@contextmanager
+def appliance_stream(function, *arguments):
+    """Streams the output of a GuestFS call writing into a host file.
+
+    function is called with the given arguments and the path
+    of a named pipe as last argument in a separate thread.
+
+    Returns the pipe readable side, the function errors are raised
+    once the stream has been consumed. If the consumer fails instead,
+    its error is raised and the function one is logged.
+
+    """
+    with tempfile.TemporaryDirectory() as tempdir:
+        fifo = os.path.join(tempdir, 'fifo')
+        os.mkfifo(fifo)
+
+        future = write_fifo(function, arguments, fifo)
+
+        try:
+            with open(fifo, 'rb') as stream:
+                yield stream
+        except BaseException:
+            # the closed read end breaks the pipe unblocking the writer
+            try:
+                future.result()
+            except Exception as error:
+                logging.debug("Appliance stream interrupted: %s", error)
+
+            raise
+
+        future.result()
+
+
+def read_records(stream, separator=b'\0'):
+    """Iterates over the separator terminated records in the stream."""
+    remainder = b''
+
+    for chunk in iter(lambda: stream.read(CHUNK_SIZE), b''):
+        records = (remainder + chunk).split(separator)
+        remainder = records.pop()
+
+        yield from records
+
+    if remainder:
+        yield remainder
+
+
+def sparse_copy(stream, destination):
+    """Copies the stream into the destination file
+    leaving holes in place of the SPARSE_CHUNK bytes blocks of zeros.
+
+    Returns the amount of bytes actually written.
+
+    """
+    written = 0
+    zeros = bytes(SPARSE_CHUNK)
+
+    with open(destination, 'wb') as output:
+        for chunk in iter(lambda: stream.read(SPARSE_CHUNK), b''):
+            if chunk == zeros[:len(chunk)]:
+                output.seek(len(chunk), os.SEEK_CUR)
+            else:
+                written += output.write(chunk)
+
+        output.truncate()
+
+    return written
+
+
+@concurrent.thread
+def write_fifo(function, arguments, fifo):
+    try:
+        function(*arguments, fifo)
+    except BaseException:
+        unblock_reader(fifo)
+        raise
+
+
+def unblock_reader(fifo):
+    """Opens and closes the FIFO if still unopened by the writer
+    so that the reader does not block forever.
+
+    """
+    try:
+        os.close(os.open(fifo, os.O_WRONLY | os.O_NONBLOCK))
+    except OSError as error:
+        if error.errno != errno.ENXIO:
+            logging.debug("Unable to unblock reader: %s", error)
+
+
+CHUNK_SIZE = 1024 * 1024
+SPARSE_CHUNK = 64 * 1024
@@ -30,21 +30,39 @@
 
 """Analyse disk content to extract File System event timelines."""
 
+import os
 import ntpath
 import logging
-from datetime import timedelta
+from datetime import datetime, timedelta
 from functools import lru_cache
 from itertools import chain, groupby
 from tempfile import NamedTemporaryFile
 from collections import defaultdict, namedtuple
 
-from vminspect.filesystem import FileSystem
+from vminspect.extsort import external_sort
+from vminspect.fsindex import FileSystemIndex
+from vminspect.filesystem import open_filesystem, posix_path
 from vminspect.usnjrnl import CorruptedUsnRecord, usn_journal
 
 
 class FSTimeline:
-    def __init__(self, disk):
+    """Timeline of the events of the File System content.
+
+    index is an optional FileSystemIndex, or the path of a stored one,
+    to read the File System content from instead of walking it.
+    If no index is stored at the path, it is built and stored there
+    for the following runs on the same disk.
+
+    """
+    def __init__(self, disk, pool=None, hashcache=None, profile=None,
+                 partition=None, index=None):
         self._disk = disk
+        self._index = index
+        self._stored_index = None
+        self._pool = pool
+        self._profile = profile
+        self._partition = partition
+        self._hashcache = hashcache
         self._filesystem = None
         self._filetype_cache = {}
         self._checksum_cache = {}
@@ -52,29 +70,50 @@ class FSTimeline:
             "%s.%s" % (self.__module__, self.__class__.__name__))
 
     def __enter__(self):
-        self._filesystem = FileSystem(self._disk)
+        self._filesystem = open_filesystem(self._disk, pool=self._pool,
+                                           hashcache=self._hashcache,
+                                           profile=self._profile,
+                                           partition=self._partition)
         self._filesystem.mount()
 
         return self
 
     def __exit__(self, *_):
+        if self._stored_index is not None:
+            self._stored_index.close()
+            self._stored_index = None
+
         self._filesystem.umount()
 
     def __getattr__(self, attr):
         return getattr(self._filesystem, attr)
 
-    def timeline(self):
-        self.logger.debug("Extracting File System timeline events.")
-        events = tuple(Event(d.inode, d.path, d.size, d.allocated, t, r)
-                       for d in self._visit_filesystem()
-                       for t, r in ((d.atime, 'access'),
-                                    (d.mtime, 'change'),
-                                    (d.ctime, 'attribute_change'),
-                                    (d.crtime, 'creation'))
-                       if t > 0)
+    def timeline(self, buffersize=1000000, since=None, until=None,
+                 prefix=None, reasons=None):
+        """Iterates over the File System events sorted by timestamp.
+
+        At most buffersize events are kept in memory,
+        sorted runs of events are spilled to disk and merged.
 
-        self.logger.debug("Sorting File System timeline events.")
-        return sorted(events, key=lambda e: e.timestamp)
+        Only the events occurred between the since and until datetimes
+        to the files under the prefix path and with the given reasons
+        are generated, see TimelineFilter.
+
+        """
+        selection = self._selection(since, until, prefix, reasons)
+
+        self.logger.debug("Extracting File System timeline events.")
+        events = (Event(d.inode, d.path, d.size, d.allocated, t, r)
+                  for d in self._visit_filesystem(selection)
+                  for t, r in ((d.atime, 'access'),
+                               (d.mtime, 'change'),
+                               (d.ctime, 'attribute_change'),
+                               (d.crtime, 'creation'))
+                  if t > 0 and selection.selected_time(t) and
+                  selection.selected_reasons(r))
+
+        return external_sort(events, key=lambda e: e.timestamp,
+                             buffersize=buffersize)
 
     @lru_cache(maxsize=None)
     def file(self, path):
@@ -94,18 +133,39 @@ class FSTimeline:
         """
         return self._filesystem.checksum(path)
 
-    def _visit_filesystem(self):
-        """Walks through the filesystem content."""
+    def _selection(self, since, until, prefix, reasons):
+        return TimelineFilter(since=since, until=until, prefix=prefix,
+                              reasons=reasons,
+                              ignorecase=self._filesystem.osname == 'windows')
+
+    def _visit_filesystem(self, selection=None):
+        """Walks through the filesystem content.
+
+        Dirents outside the selection prefix are skipped.
+
+        """
         self.logger.debug("Parsing File System content.")
 
-        root_partition = self._filesystem.inspect_get_roots()[0]
+        root_partition = self._filesystem.inspection.root
+
+        for dirent in self._root_dirent():
+            if selection is None or selection.selected_path(dirent.path):
+                yield dirent
 
-        yield from self._root_dirent()
+        if self._index is not None:
+            yield from (index_dirent(e) for e in self._filesystem_index()
+                        if selection is None or
+                        selection.selected_path(e.path))
+            return
 
         for entry in self._filesystem.filesystem_walk(root_partition):
+            path = self._filesystem.path('/' + entry['tsk_name'])
+
+            if selection is not None and not selection.selected_path(path):
+                continue
+
             yield Dirent(
-                entry['tsk_inode'],
-                self._filesystem.path('/' + entry['tsk_name']),
+                entry['tsk_inode'], path,
                 entry['tsk_size'], entry['tsk_type'],
                 True if entry['tsk_flags'] & TSK_ALLOC else False,
                 timestamp(entry['tsk_atime_sec'], entry['tsk_atime_nsec']),
@@ -113,6 +173,25 @@ class FSTimeline:
                 timestamp(entry['tsk_ctime_sec'], entry['tsk_ctime_nsec']),
                 timestamp(entry['tsk_crtime_sec'], entry['tsk_crtime_nsec']))
 
+    def _filesystem_index(self):
+        """Returns the given index loading the stored one,
+        it is built and stored if missing.
+
+        """
+        if not isinstance(self._index, str):
+            return self._index
+
+        if self._stored_index is None:
+            if os.path.exists(self._index):
+                self._stored_index = FileSystemIndex.load(self._index)
+            else:
+                self.logger.debug("Building File System index.")
+
+                self._stored_index = FileSystemIndex.build(self._filesystem)
+                self._stored_index.save(self._index)
+
+        return self._stored_index
+
     def _root_dirent(self):
         """Returns the root folder dirent as filesystem_walk API doesn't."""
         fstat = self._filesystem.stat('/')
@@ -133,8 +212,10 @@ class NTFSTimeline(FSTimeline):
       https://github.com/noxdafox/libguestfs/tree/forensics
 
     """
-    def __init__(self, disk):
-        super().__init__(disk)
+    def __init__(self, disk, pool=None, hashcache=None, profile=None,
+                 partition=None, index=None):
+        super().__init__(disk, pool=pool, hashcache=hashcache,
+                         profile=profile, partition=partition, index=index)
 
     def __enter__(self):
         super().__enter__()
@@ -146,7 +227,8 @@ class NTFSTimeline(FSTimeline):
 
         return self
 
-    def usnjrnl_timeline(self):
+    def usnjrnl_timeline(self, since=None, until=None, prefix=None,
+                         reasons=None):
         """Iterates over the changes occurred within the filesystem.
 
         Yields UsnJrnlEvent namedtuples containing:
@@ -159,44 +241,131 @@ class NTFSTimeline(FSTimeline):
             changes: list of changes applied to the file.
             attributes: list of file attributes.
 
+        Records occurred outside the since and until datetimes
+        are discarded while parsing the journal, changes without any of
+        the given reasons are not resolved and changes to files outside
+        the prefix path are discarded once their path is known.
+        See TimelineFilter.
+
         """
+        selection = self._selection(since, until, prefix, reasons)
         filesystem_content = defaultdict(list)
 
         self.logger.debug("Extracting Update Sequence Number journal.")
 
-        journal = self._read_journal()
+        journal = self._read_journal(selection)
 
         for dirent in self._visit_filesystem():
             filesystem_content[dirent.inode].append(dirent)
 
         self.logger.debug("Generating timeline.")
-        yield from generate_timeline(journal, filesystem_content)
+        yield from (e for e in generate_timeline(journal, filesystem_content,
+                                                 selection=selection)
+                    if selection.selected_path(e.path))
 
-    def _read_journal(self):
+    def _read_journal(self, selection=None):
         """Extracts the USN journal from the disk and parses its content."""
-        root = self._filesystem.inspect_get_roots()[0]
+        root = self._filesystem.inspection.root
         inode = self._filesystem.stat('C:\\$Extend\\$UsnJrnl')['ino']
 
         with NamedTemporaryFile(buffering=0) as tempfile:
-            self._filesystem.download_inode(root, inode, tempfile.name)
+            self._filesystem.download_inode(root, inode, tempfile.name,
+                                            sparse=True)
 
             journal = usn_journal(tempfile.name)
 
-            return parse_journal(journal)
+            return parse_journal(journal, selection=selection)
+
+
+class TimelineFilter:
+    """Selects the timeline events.
 
+    since and until are UTC datetimes delimiting the events
+    occurred within the window, both inclusive.
 
-def parse_journal(journal):
+    prefix is the path of the folder which files events are selected,
+    matched against the POSIX form of the paths
+    (C:\\Users -> /Users) case insensitively if ignorecase is True.
+
+    reasons are the File System event reasons (access, change, ...)
+    or the USN journal changes (FILE_CREATE, FILE_DELETE, ...) selected.
+
+    """
+    def __init__(self, since=None, until=None, prefix=None, reasons=None,
+                 ignorecase=False):
+        self.since = since
+        self.until = until
+        self.ignorecase = ignorecase
+        self.reasons = frozenset(reasons) if reasons else None
+        self.prefix = (self._normalize(posix_path(prefix)).rstrip('/')
+                       if prefix else None)
+        self._window = tuple(None if d is None else
+                             ((d - EPOCH).total_seconds(), d.isoformat(' '))
+                             for d in (since, until))
+
+    def __repr__(self):
+        return "%s(since=%s, until=%s, prefix=%s, reasons=%s)" % (
+            self.__class__.__name__, self.since, self.until, self.prefix,
+            self.reasons)
+
+    def selected_time(self, timestamp):
+        """Returns True if the timestamp lies within the window.
+
+        timestamp is either the seconds since the epoch
+        or the USN journal date string.
+
+        """
+        index = 1 if isinstance(timestamp, str) else 0
+        since, until = self._window
+
+        return ((since is None or timestamp >= since[index]) and
+                (until is None or timestamp <= until[index]))
+
+    def selected_path(self, path):
+        """Returns True if the path lies under the prefix."""
+        if self.prefix is None:
+            return True
+
+        path = self._normalize(posix_path(path))
+
+        return path.startswith(self.prefix + '/') or path == self.prefix
+
+    def selected_reasons(self, *reasons):
+        """Returns True if any of the reasons is selected."""
+        return self.reasons is None or not self.reasons.isdisjoint(reasons)
+
+    def _normalize(self, string):
+        return string.lower() if self.ignorecase else string
+
+
+def parse_journal(journal, selection=None):
     """Parses the USN Journal content removing duplicates
     and corrupted records.
 
+    If a TimelineFilter is given, the records outside its time window
+    are discarded except for the folders ones needed to resolve the paths.
+
     """
-    events = [e for e in journal if not isinstance(e, CorruptedUsnRecord)]
+    events = []
+    corrupted = filtered = 0
+
+    for event in journal:
+        if isinstance(event, CorruptedUsnRecord):
+            corrupted += 1
+        elif (selection is None or selection.selected_time(event.timestamp) or
+              'DIRECTORY' in event.file_attributes):
+            events.append(event)
+        else:
+            filtered += 1
+
     keyfunc = lambda e: str(e.file_reference_number) + e.file_name + e.timestamp
     event_groups = (tuple(g) for k, g in groupby(events, key=keyfunc))
 
-    if len(events) < len(list(journal)):
-        LOGGER.debug(
-            "Corrupted records in UsnJrnl, some events might be missing.")
+    if corrupted:
+        LOGGER.debug("%d corrupted records in UsnJrnl, "
+                     "some events might be missing.", corrupted)
+    if filtered:
+        LOGGER.debug("%d UsnJrnl records outside the time window.", filtered)
 
     return [journal_event(g) for g in event_groups]
 
@@ -213,18 +382,27 @@ def journal_event(events):
                      list(reasons), list(attributes))
 
 
-def generate_timeline(usnjrnl, filesystem_content):
+def generate_timeline(usnjrnl, filesystem_content, selection=None):
     """Aggregates the data collected from the USN journal
     and the filesystem content.
 
+    If a TimelineFilter is given, only the events within its time window
+    and with its reasons are resolved.
+
     """
     journal_content = defaultdict(list)
     for event in usnjrnl:
         journal_content[event.inode].append(event)
 
+    if selection is not None:
+        usnjrnl = [e for e in usnjrnl if selection.selected_time(e.timestamp)
+                   and selection.selected_reasons(*e.changes)]
+
+    resolver = DirentResolver(filesystem_content, journal_content)
+
     for event in usnjrnl:
         try:
-            dirent = lookup_dirent(event, filesystem_content, journal_content)
+            dirent = resolver.lookup(event)
 
             yield UsnJrnlEvent(
                 dirent.inode, dirent.path, dirent.size, dirent.allocated,
@@ -233,42 +411,97 @@ def generate_timeline(usnjrnl, filesystem_content):
             LOGGER.debug(error)
 
 
-def lookup_dirent(event, filesystem_content, journal_content):
-    """Lookup the dirent given a journal event."""
-    for dirent in filesystem_content[event.inode]:
-        if dirent.path.endswith(event.name):
+class DirentResolver:
+    """Resolves the dirents of the USN journal events.
+
+    The File System dirents are indexed by inode and name,
+    the paths of the folders are resolved once through
+    their parent references, deleted folders included.
+
+    """
+    def __init__(self, filesystem_content, journal_content):
+        self._content = filesystem_content
+        self._dirents = {}
+        self._folders = {}
+        self._deleted = {}
+        self._paths = {}
+
+        for inode, dirents in filesystem_content.items():
+            for dirent in dirents:
+                key = inode, dirent.path.rpartition('\\')[2]
+                if key not in self._dirents:
+                    self._dirents[key] = dirent
+
+                if dirent.type == 'd' and dirent.allocated and \
+                   inode not in self._folders:
+                    self._folders[inode] = dirent.path
+
+        for inode, events in journal_content.items():
+            for event in events:
+                if 'DIRECTORY' in event.attributes and \
+                   'FILE_DELETE' in event.changes:
+                    self._deleted[inode] = event
+                    break
+
+    def lookup(self, event):
+        """Lookup the dirent given a journal event."""
+        dirent = self._dirents.get((event.inode, event.name))
+        if dirent is not None:
             return dirent
 
-    path = lookup_folder(event, filesystem_content)
-    if path is not None:
-        return Dirent(event.inode, path, -1, None, False, 0, 0, 0, 0)
+        for dirent in self._content.get(event.inode, ()):
+            if dirent.path.endswith(event.name):
+                return dirent
+
+        path = self._folders.get(event.parent_inode)
+        if path is None:
+            path = self.folder_path(event.parent_inode)
+        if path is not None:
+            return Dirent(event.inode, ntpath.join(path, event.name),
+                          -1, None, False, 0, 0, 0, 0)
+
+        raise LookupError("File %s not found" % event.name)
 
-    path = lookup_deleted_folder(event, filesystem_content, journal_content)
-    if path is not None:
-        return Dirent(event.inode, path, -1, None, False, 0, 0, 0, 0)
+    def folder_path(self, inode):
+        """Returns the path of the folder with the given inode
+        following the deleted folders parent references.
+
+        Returns None if the path cannot be resolved
+        or the references form a cycle.
+
+        """
+        chain = []
 
-    raise LookupError("File %s not found" % event.name)
+        while inode not in self._paths:
+            if inode not in self._deleted:
+                self._paths[inode] = self._folders.get(inode)
+                break
+            if inode in chain:
+                LOGGER.debug("Cyclic parent references in UsnJrnl.")
+                self._paths[inode] = None
+                break
 
+            chain.append(inode)
+            inode = self._deleted[inode].parent_inode
 
-def lookup_folder(event, filesystem):
-    """Lookup the parent folder in the filesystem content."""
-    for dirent in filesystem[event.parent_inode]:
-        if dirent.type == 'd' and dirent.allocated:
-            return ntpath.join(dirent.path, event.name)
+        path = self._paths[inode]
 
+        for inode in reversed(chain):
+            if path is not None:
+                path = ntpath.join(path, self._deleted[inode].name)
 
-def lookup_deleted_folder(event, filesystem, journal):
-    """Lookup the parent folder in the journal content."""
-    folder_events = (e for e in journal[event.parent_inode]
-                     if 'DIRECTORY' in e.attributes
-                     and 'FILE_DELETE' in e.changes)
+            self._paths[inode] = path
 
-    for folder_event in folder_events:
-        path = lookup_deleted_folder(folder_event, filesystem, journal)
+        return path
 
-        return ntpath.join(path, event.name)
 
-    return lookup_folder(event, filesystem)
+def index_dirent(entry):
+    """Converts a FileSystemIndex entry into a Dirent."""
+    return Dirent(entry.inode, entry.path, entry.size,
+                  '' if entry.type == '-' else entry.type, entry.allocated,
+                  *(timestamp(*divmod(t, 1000000000))
+                    for t in (entry.atime, entry.mtime,
+                              entry.ctime, entry.crtime)))
 
 
 def timestamp(secs, nsecs):
@@ -278,6 +511,7 @@ def timestamp(secs, nsecs):
 
 
 TSK_ALLOC = 0x01
+EPOCH = datetime(1970, 1, 1)
 
 
 Event = namedtuple('Event',
@@ -31,10 +31,14 @@
 """Module for parsing Windows Update Sequence Number Journal."""
 
 
-import io
+import os
+import re
+import mmap
+import errno
 import struct
 
 from itertools import count
+from functools import lru_cache
 from collections import namedtuple
 from datetime import datetime, timedelta
 
@@ -43,32 +47,89 @@ def usn_journal(path):
     """Iterates over the Windows Update Sequence Number entries
     contained in the file at the given path.
 
+    The file is memory mapped and parsed in place,
+    the holes of sparse files are skipped without reading them.
+
     """
     with open(path, 'rb') as journal_file:
-        yield from parse_journal_file(journal_file)
+        if os.fstat(journal_file.fileno()).st_size == 0:
+            return
 
+        regions = data_regions(journal_file.fileno())
 
-def parse_journal_file(journal_file):
-    """Iterates over the journal's file taking care of paddings."""
+        with mmap.mmap(journal_file.fileno(), 0,
+                       access=mmap.ACCESS_READ) as mapping:
+            yield from parse_journal_buffer(mapping, regions=regions)
+
+
+def data_regions(fileno):
+    """Returns the (start, end) offsets of the data regions of the file
+    skipping its holes.
+
+    The whole file is a single region if holes cannot be detected.
+
+    """
+    size = os.fstat(fileno).st_size
+    regions = []
+    position = 0
+
+    try:
+        while position < size:
+            start = os.lseek(fileno, position, os.SEEK_DATA)
+            position = os.lseek(fileno, start, os.SEEK_HOLE)
+            regions.append((start, position))
+    except AttributeError:  # SEEK_DATA not supported by the platform
+        return [(0, size)]
+    except OSError as error:
+        if error.errno != errno.ENXIO:  # no data past position
+            return [(0, size)]
+
+    return regions
+
+
+def parse_journal_buffer(buffer, regions=None):
+    """Iterates over the journal's buffer walking the records by offset.
+
+    Records are parsed through memoryview slices without copying
+    the buffer, zero paddings are skipped preserving the 8 bytes alignment.
+
+    regions is an optional list of (start, end) offsets
+    of the buffer areas to be parsed, the rest is deemed zeros.
+
+    """
     counter = count()
 
-    for block in read_next_block(journal_file):
-        block = remove_nullchars(block)
+    if regions is None:
+        regions = ((0, len(buffer)), )
 
-        while len(block) > MIN_RECORD_SIZE:
-            header = RECORD_HEADER.unpack_from(block)
-            size = header[0]
+    with memoryview(buffer) as view:
+        for start, end in regions:
+            position = skip_nullchars(buffer, start, end)
 
-            try:
-                yield parse_record(header, block[:size])
+            while end - position > MIN_RECORD_SIZE:
+                header = RECORD_HEADER.unpack_from(view, position)
+                size = header[0] or RECORD_ALIGNMENT  # skip empty headers
+                record = view[position:min(position + size, end)]
 
-                next(counter)
-            except RuntimeError:
-                yield CorruptedUsnRecord(next(counter))
-            finally:
-                block = remove_nullchars(block[size:])
+                try:
+                    entry = parse_record(header, record)
+                except RuntimeError:
+                    entry = CorruptedUsnRecord(next(counter))
+                else:
+                    next(counter)
+                finally:
+                    record.release()
 
-        journal_file.seek(- len(block), 1)
+                yield entry
+
+                position = min(position + size, end)
+                if position < end and buffer[position] == 0:
+                    position = skip_nullchars(buffer, position, end)
+
+
+def parse_journal_file(journal_file):
+    """Iterates over the journal's file content."""
+    yield from parse_journal_buffer(journal_file.read())
 
 
 def parse_record(header, record):
@@ -87,20 +148,19 @@ def usn_v2_record(header, record):
     fields = V2_RECORD.unpack_from(record, RECORD_HEADER.size)
 
     return UsnRecord(length,
-                     float('{}.{}'.format(major_version, minor_version)),
+                     record_version(major_version, minor_version),
                      fields[0] | fields[1] << 16,  # 6 bytes little endian mft
                      fields[2],  # 2 bytes little endian mft sequence
                      fields[3] | fields[4] << 16,  # 6 bytes little endian mft
                      fields[5],  # 2 bytes little endian mft sequence
                      fields[6],
-                     (datetime(1601, 1, 1) +
+                     (NTFS_EPOCH +
                       timedelta(microseconds=(fields[7] / 10))).isoformat(' '),
                      unpack_flags(fields[8], REASONS),
                      unpack_flags(fields[9], SOURCEINFO),
                      fields[10],
                      unpack_flags(fields[11], ATTRIBUTES),
-                     str(struct.unpack_from('{}s'.format(fields[12]).encode(),
-                                            record, fields[13])[0], 'utf16'))
+                     file_name(record, fields[12], fields[13]))
 
 
 def usn_v3_record(header, record):
@@ -109,20 +169,19 @@ def usn_v3_record(header, record):
     fields = V3_RECORD.unpack_from(record, RECORD_HEADER.size)
 
     return UsnRecord(length,
-                     float('{}.{}'.format(major_version, minor_version)),
+                     record_version(major_version, minor_version),
                      fields[0],
                      fields[1],
                      fields[2],
                      fields[3],
                      fields[4],
-                     (datetime(1601, 1, 1) +
+                     (NTFS_EPOCH +
                       timedelta(microseconds=(fields[5] / 10))).isoformat(' '),
                      unpack_flags(fields[6], REASONS),
                      unpack_flags(fields[7], SOURCEINFO),
                      fields[8],
                      unpack_flags(fields[9], ATTRIBUTES),
-                     str(struct.unpack_from('{}s'.format(fields[10]).encode(),
-                                            record, fields[11])[0], 'utf16'))
+                     file_name(record, fields[10], fields[11]))
 
 
 def usn_v4_record(header, record):
@@ -133,6 +192,21 @@ def usn_v4_record(header, record):
     raise NotImplementedError('Not implemented')
 
 
+@lru_cache(maxsize=None)
+def record_version(major_version, minor_version):
+    return float('{}.{}'.format(major_version, minor_version))
+
+
+def file_name(record, length, offset):
+    """Decodes the UTF16 file name within the record."""
+    return str(name_struct(length).unpack_from(record, offset)[0], 'utf16')
+
+
+@lru_cache(maxsize=1024)
+def name_struct(length):
+    return struct.Struct('{}s'.format(length))
+
+
 def unpack_flags(value, flags):
     """Multiple flags might be packed in the same field."""
     try:
@@ -141,23 +215,15 @@ def unpack_flags(value, flags):
         return [flags[k] for k in sorted(flags.keys()) if k & value > 0]
 
 
-def read_next_block(infile, block_size=io.DEFAULT_BUFFER_SIZE):
-    """Iterates over the file in blocks."""
-    chunk = infile.read(block_size)
-
-    while chunk:
-        yield chunk
-
-        chunk = infile.read(block_size)
+def skip_nullchars(buffer, start, end):
+    """Returns the offset of the first non NULL char in buffer[start:end]
+    taking care of bytes alignment.
 
+    """
+    match = NON_NULLCHAR.search(buffer, start, end)
+    stripped = (match.start() if match is not None else end) - start
 
-def remove_nullchars(block):
-    """Strips NULL chars taking care of bytes alignment."""
-    data = block.lstrip(b'\00')
-
-    padding = b'\00' * ((len(block) - len(data)) % 8)
-
-    return padding + data
+    return start + stripped - stripped % RECORD_ALIGNMENT
 
 
 RECORD_PARSER = {2: usn_v2_record,
@@ -177,6 +243,9 @@ V4_RECORD = struct.Struct('QQqqIIIIhh')  # TODO
 MIN_RECORD_SIZE = RECORD_HEADER.size + min(V2_RECORD.size,
                                            V3_RECORD.size,
                                            V4_RECORD.size)
+RECORD_ALIGNMENT = 8
+NTFS_EPOCH = datetime(1601, 1, 1)
+NON_NULLCHAR = re.compile(b'[^\x00]')
 
 
 UsnRecord = namedtuple('UsnRecord', ('length',
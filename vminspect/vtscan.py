@@ -35,7 +35,7 @@ import requests
 from collections import namedtuple
 from itertools import chain, islice
 
-from vminspect.filesystem import FileSystem
+from vminspect.filesystem import open_filesystem
 
 
 VTReport = namedtuple('VTReport', ('path', 'hash', 'detections'))
@@ -51,9 +51,12 @@ class VTScanner:
 
     The attribute batchsize controls the amount of object per VT query.
 
+    pool is an optional FileSystemPool used for mounting the disk.
+
     """
-    def __init__(self, disk, apikey):
+    def __init__(self, disk, apikey, pool=None):
         self._disk = disk
+        self._pool = pool
         self._apikey = apikey
         self._filesystem = None
         self.batchsize = 1
@@ -61,7 +64,7 @@ class VTScanner:
             "%s.%s" % (self.__module__, self.__class__.__name__))
 
     def __enter__(self):
-        self._filesystem = FileSystem(self._disk)
+        self._filesystem = open_filesystem(self._disk, pool=self._pool)
         self._filesystem.mount()
 
         return self
@@ -76,7 +79,7 @@ class VTScanner:
     def apikey(self):
         return self._apikey
 
-    def scan(self, filetypes=None):
+    def scan(self, filetypes=None, policy=None):
         """Iterates over the content of the disk and queries VirusTotal
         to determine whether it's malicious or not.
 
@@ -84,6 +87,8 @@ class VTScanner:
         If given, only the files which type will match with one or more of
         the given patterns will be queried against VirusTotal.
 
+        policy is an optional HashPolicy selecting the files to be hashed.
+
         For each file which is unknown by VT or positive to any of its engines,
         the method yields a namedtuple:
 
@@ -98,7 +103,7 @@ class VTScanner:
         print("I'm here!1")
 
         self.logger.debug("Scanning FS content.")
-        all_checksums = self._filesystem.checksums('/')
+        all_checksums = self._filesystem.checksums('/', policy=policy)
 
         print("I'm here!2")
 
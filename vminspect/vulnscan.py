@@ -32,7 +32,7 @@ import logging
 from collections import namedtuple
 from concurrent.futures import ThreadPoolExecutor
 
-from vminspect.filesystem import FileSystem
+from vminspect.filesystem import LocalFileSystem, open_filesystem
 
 from load_cve import load_local
 
@@ -42,11 +42,13 @@ class VulnScanner:
     Allows to scan the given disk content and query
     a CVE DB for vulnerabilities.
 
-    disk must contain the path of a valid disk image.
+    disk must contain the path of a valid disk image,
+    directories are accepted but contain no installed applications list.
 
     """
-    def __init__(self, disk, cvefeed):
+    def __init__(self, disk, cvefeed, pool=None):
         self._disk = disk
+        self._pool = pool
         self._filesystem = None
         self._cvefeed = load_local(cvefeed)['CVE_Items']
         self.logger = logging.getLogger(
@@ -54,7 +56,7 @@ class VulnScanner:
         self.logger.setLevel(50)
 
     def __enter__(self):
-        self._filesystem = FileSystem(self._disk)
+        self._filesystem = open_filesystem(self._disk, pool=self._pool)
         self._filesystem.mount()
 
         return self
@@ -129,6 +131,9 @@ class VulnScanner:
         
 
     def applications(self):
+        if isinstance(self._filesystem, LocalFileSystem):
+            raise RuntimeError("Applications are listed on disk images only.")
+
         return (Application(a['app2_name'], a['app2_version'], a['app2_publisher'])
                 for a in self._filesystem.inspect_list_applications2(
                         self._filesystem._root))
@@ -36,7 +36,7 @@ from tempfile import NamedTemporaryFile
 
 from Evtx.Evtx import FileHeader
 from Evtx.Views import evtx_file_xml_view
-from vminspect.filesystem import FileSystem
+from vminspect.filesystem import open_filesystem
 
 
 class WinEventLog:
@@ -45,14 +45,15 @@ class WinEventLog:
     Allows to retrieve the Events contained within Windows Event Log files.
 
     """
-    def __init__(self, disk):
+    def __init__(self, disk, pool=None):
         self._disk = disk
+        self._pool = pool
         self._filesystem = None
         self.logger = logging.getLogger(
             "%s.%s" % (self.__module__, self.__class__.__name__))
 
     def __enter__(self):
-        self._filesystem = FileSystem(self._disk)
+        self._filesystem = open_filesystem(self._disk, pool=self._pool)
         self._filesystem.mount()
 
         return self